@@ -7,12 +7,20 @@ Purpose: Pivot combined predictions to have one row per contig
 
 import argparse
 import os
+import sys
 from typing import NamedTuple, TextIO
 
 import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal, assert_series_equal
 
+# Predictions are completed with the module shared by classify_simulated
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                 'classify_simulated'))
+from classifications import (  # type: ignore # noqa: E402
+    complete_classifications)
+
 
 class Args(NamedTuple):
     """ Command-line arguments """
@@ -102,65 +110,6 @@ def test_clean_records() -> None:
     assert_series_equal(clean_records(in_col), out_col)
 
 
-# --------------------------------------------------
-def complete_classifications(df: pd.DataFrame) -> pd.DataFrame:
-    """ Fill in missing classifications """
-
-    out_df = pd.DataFrame(
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    for metagenome, metagenome_df in df.groupby('metagenome'):
-        metagenome = metagenome_df['metagenome'].unique()
-        all_records = metagenome_df['record'].unique()
-        all_tools = metagenome_df['tool'].unique()
-        names = ['record', 'tool']
-
-        multi_index = pd.MultiIndex.from_product([all_records, all_tools],
-                                                 names=names)
-
-        metagenome_df = metagenome_df.set_index(names).reindex(
-            multi_index).reset_index()
-        metagenome_df['metagenome'] = metagenome_df['metagenome'].fillna(
-            metagenome[0])
-
-        out_df = pd.concat([out_df, metagenome_df])
-
-    out_df['prediction'] = out_df['prediction'].fillna('non-viral')
-    out_df = out_df.reset_index(drop=True)
-
-    return out_df
-
-
-# --------------------------------------------------
-def test_complete_classifications() -> None:
-    """ Test complete_classifications() """
-
-    in_df = pd.DataFrame(
-        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_miseq', 'viral']],
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    out_df = pd.DataFrame(
-        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_miseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k142', 'Adult1_miseq', 'non-viral']],
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    assert_frame_equal(complete_classifications(in_df), out_df)
-
-
 # --------------------------------------------------
 def clean_predictions(df: pd.DataFrame) -> pd.DataFrame:
     """ Fill in missing predicitons, and fix predicted labels """
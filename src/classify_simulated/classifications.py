@@ -0,0 +1,152 @@
+"""
+Complete tool predictions, so every tool has a prediction for every record
+"""
+
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+
+# --------------------------------------------------
+def encode_within(groups: np.ndarray, n_groups: int,
+                  values: pd.Series) -> Tuple[np.ndarray, ...]:
+    """ Number distinct values in order of appearance within each group """
+
+    value_codes, uniques = pd.factorize(values)
+    labels = np.asarray(uniques, dtype=object)
+
+    # Missing values are kept, with a code of their own
+    if (value_codes < 0).any():
+        value_codes[value_codes < 0] = len(labels)
+        labels = np.append(labels, np.array([np.nan], dtype=object))
+
+    # Distinct (group, value) pairs, in order of first appearance
+    keys = groups.astype(np.int64) * len(labels) + value_codes
+    pairs = pd.unique(keys)
+    pairs = pairs[np.argsort(pairs // len(labels), kind='stable')]
+
+    counts = np.bincount(pairs // len(labels), minlength=n_groups)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    position = pd.Index(pairs).get_indexer(keys)
+    codes = position - offsets[groups]
+
+    return codes, counts, offsets, labels[pairs % len(labels)]
+
+
+# --------------------------------------------------
+def complete_classifications(df: pd.DataFrame) -> pd.DataFrame:
+    """ Fill in missing classifications """
+
+    cols = ['tool', 'record', 'metagenome', 'prediction']
+
+    meta_codes, metagenomes = pd.factorize(df['metagenome'], sort=True)
+    df = df[meta_codes >= 0]
+    meta_codes = meta_codes[meta_codes >= 0]
+    n_meta = len(metagenomes)
+
+    if not n_meta:
+        return pd.DataFrame(columns=cols, index=pd.RangeIndex(0))
+
+    # Records and tools are numbered within each metagenome
+    rec_codes, n_recs, rec_offsets, rec_labels = encode_within(
+        meta_codes, n_meta, df['record'])
+    tool_codes, n_tools, tool_offsets, tool_labels = encode_within(
+        meta_codes, n_meta, df['tool'])
+
+    # Each metagenome has a block of records by tools, in one array
+    sizes = n_recs * n_tools
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    predictions = np.full(sizes.sum(), 'non-viral', dtype=object)
+    predictions[starts[meta_codes] + rec_codes * n_tools[meta_codes] +
+                tool_codes] = df['prediction'].fillna('non-viral').to_numpy()
+
+    meta = np.repeat(np.arange(n_meta), sizes)
+    within = np.arange(sizes.sum()) - starts[meta]
+
+    return pd.DataFrame({
+        'tool': tool_labels[tool_offsets[meta] + within % n_tools[meta]],
+        'record': rec_labels[rec_offsets[meta] + within // n_tools[meta]],
+        'metagenome': np.asarray(metagenomes, dtype=object)[meta],
+        'prediction': predictions
+    })
+
+
+# --------------------------------------------------
+def test_complete_classifications() -> None:
+    """ Test complete_classifications() """
+
+    in_df = pd.DataFrame(
+        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
+         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
+         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
+         ['seeker', 'k141', 'Adult1_miseq', 'viral']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    out_df = pd.DataFrame(
+        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
+         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
+         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
+         ['seeker', 'k142', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
+         ['seeker', 'k143', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
+         ['seeker', 'k141', 'Adult1_miseq', 'viral'],
+         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
+         ['seeker', 'k142', 'Adult1_miseq', 'non-viral']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    assert_frame_equal(complete_classifications(in_df), out_df)
+
+    # Tools are only completed in metagenomes where they were run
+    in_df = pd.DataFrame(
+        [['seeker', 'k142', 'Adult1_miseq', None],
+         ['dvf', 'k141', 'Adult1_hiseq', 'viral'],
+         ['seeker', 'k141', 'Adult1_miseq', 'viral'],
+         ['vibrant', 'k142', 'Adult1_hiseq', 'phage']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    out_df = pd.DataFrame(
+        [['dvf', 'k141', 'Adult1_hiseq', 'viral'],
+         ['vibrant', 'k141', 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
+         ['vibrant', 'k142', 'Adult1_hiseq', 'phage'],
+         ['seeker', 'k142', 'Adult1_miseq', 'non-viral'],
+         ['seeker', 'k141', 'Adult1_miseq', 'viral']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    assert_frame_equal(complete_classifications(in_df), out_df)
+
+    # Records that could not be cleaned are still completed
+    in_df = pd.DataFrame(
+        [['dvf', np.nan, 'Adult1_hiseq', 'viral'],
+         ['seeker', 'k141', 'Adult1_hiseq', 'phage']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    out_df = pd.DataFrame(
+        [['dvf', np.nan, 'Adult1_hiseq', 'viral'],
+         ['seeker', np.nan, 'Adult1_hiseq', 'non-viral'],
+         ['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
+         ['seeker', 'k141', 'Adult1_hiseq', 'phage']],
+        columns=['tool', 'record', 'metagenome', 'prediction'])
+
+    assert_frame_equal(complete_classifications(in_df), out_df)
+
+    # Record stays text when all records are missing
+    out_df = complete_classifications(in_df.iloc[:1])
+
+    assert out_df['record'].dtype == object
+    assert out_df['record'].isna().all()
+
+    # Empty predictions
+    out_df = complete_classifications(in_df.iloc[:0])
+
+    assert_frame_equal(
+        out_df,
+        pd.DataFrame(columns=in_df.columns, index=pd.RangeIndex(0)))
@@ -7,14 +7,14 @@ Purpose: Calculate performance metrics
 
 import argparse
 import os
-from typing import NamedTuple, TextIO
-from pandas._testing.asserters import assert_almost_equal
+from typing import List, NamedTuple, TextIO
 
-from sklearn.metrics import confusion_matrix
 import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal, assert_series_equal
 
+from classifications import complete_classifications
+
 
 class Args(NamedTuple):
     """ Command-line arguments """
@@ -26,19 +26,6 @@ class Args(NamedTuple):
     out_dir: str
 
 
-# --------------------------------------------------
-class Metrics(NamedTuple):
-    """ Classification metrics """
-    tn: int
-    fp: int
-    fn: int
-    tp: int
-    specificity: float
-    sensitivity: float
-    precision: float
-    f1: float
-
-
 # --------------------------------------------------
 def get_args() -> Args:
     """ Get command-line arguments """
@@ -112,65 +99,6 @@ def test_clean_records() -> None:
     assert_series_equal(clean_records(in_col), out_col)
 
 
-# --------------------------------------------------
-def complete_classifications(df: pd.DataFrame) -> pd.DataFrame:
-    """ Fill in missing classifications """
-
-    out_df = pd.DataFrame(
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    for metagenome, metagenome_df in df.groupby('metagenome'):
-        metagenome = metagenome_df['metagenome'].unique()
-        all_records = metagenome_df['record'].unique()
-        all_tools = metagenome_df['tool'].unique()
-        names = ['record', 'tool']
-
-        multi_index = pd.MultiIndex.from_product([all_records, all_tools],
-                                                 names=names)
-
-        metagenome_df = metagenome_df.set_index(names).reindex(
-            multi_index).reset_index()
-        metagenome_df['metagenome'] = metagenome_df['metagenome'].fillna(
-            metagenome[0])
-
-        out_df = pd.concat([out_df, metagenome_df])
-
-    out_df['prediction'] = out_df['prediction'].fillna('non-viral')
-    out_df = out_df.reset_index(drop=True)
-
-    return out_df
-
-
-# --------------------------------------------------
-def test_complete_classifications() -> None:
-    """ Test complete_classifications() """
-
-    in_df = pd.DataFrame(
-        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_miseq', 'viral']],
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    out_df = pd.DataFrame(
-        [['dvf', 'k141', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k141', 'Adult1_hiseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k142', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['seeker', 'k143', 'Adult1_hiseq', 'non-viral'],
-         ['dvf', 'k141', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k141', 'Adult1_miseq', 'viral'],
-         ['dvf', 'k142', 'Adult1_miseq', 'viral'],
-         ['seeker', 'k142', 'Adult1_miseq', 'non-viral']],
-        columns=['tool', 'record', 'metagenome', 'prediction'])
-
-    assert_frame_equal(complete_classifications(in_df), out_df)
-
-
 # --------------------------------------------------
 def relabel_predictions(pred_column: pd.Series) -> pd.Series:
     """ Relabel predictions for consistency"""
@@ -302,108 +230,108 @@ def add_taxonomy(preds: pd.DataFrame, tax: pd.DataFrame) -> pd.DataFrame:
 # --------------------------------------------------
 def bin_lengths(df: pd.DataFrame, bin_width: float, min_bin: float,
                 max_bin: float) -> pd.DataFrame:
+    """ Assign lengths to bins by lower boundary, 0 if below all bins """
 
-    breaks = [
+    breaks = np.array([
         x / 100 for x in list(
             range(int(min_bin * 100), int((max_bin + bin_width) *
                                           100), int(bin_width * 100)))
-    ]
+    ])
 
     df['log_length'] = np.log10(df['length'])
 
-    df['length_bin'] = 0
+    # Index of highest boundary not above each length, 0 if none
+    bin_index = np.digitize(df['log_length'], breaks)
+    bin_index[df['log_length'].isna().to_numpy()] = 0
 
-    for bin in breaks:
-        df['length_bin'] = np.where(df['log_length'] >= bin, bin,
-                                    df['length_bin'])
+    df['length_bin'] = np.where(bin_index > 0,
+                                breaks[np.maximum(bin_index - 1, 0)], 0.)
 
     return df
 
 
 # --------------------------------------------------
-def calc_metrics(true: np.array, pred: np.array) -> Metrics:
-    """ Caculate classification performance metrics """
+def test_bin_lengths() -> None:
+    """ Test bin_lengths() """
+
+    in_df = pd.DataFrame({'length': [100, 316, 317, 1000, 10**6, np.nan]})
 
-    conf_mat = confusion_matrix(true, pred, labels=['non-viral', 'viral'])
+    out_df = bin_lengths(in_df, 0.5, 2.5, 5.0)
 
-    tn, fp, fn, tp = conf_mat.ravel()
+    assert list(out_df['length_bin']) == [0., 0., 2.5, 3., 5., 0.]
+
+
+# --------------------------------------------------
+def count_outcomes(df: pd.DataFrame, groups: List[str]) -> pd.DataFrame:
+    """ Count true and false positives and negatives in each group """
 
-    specificity = np.nan if (tn + fp) == 0 else tn / (tn + fp)
-    sensitivity = np.nan if (tp + fn) == 0 else tp / (tp + fn)
-    precision = np.nan if (tp + fp) == 0 else tp / (tp + fp)
-    f1 = np.nan if (
-        np.isnan(precision) or np.isnan(sensitivity) or
-        (precision + sensitivity)
-        == 0) else 2 * precision * sensitivity / (precision + sensitivity)
+    actual = df['actual_class'].to_numpy()
+    pred = df['prediction'].to_numpy()
 
-    return Metrics(tn, fp, fn, tp, specificity, sensitivity, precision, f1)
+    # Labels other than these are not counted
+    actual_pos, actual_neg = actual == 'viral', actual == 'non-viral'
+    pred_pos, pred_neg = pred == 'viral', pred == 'non-viral'
+
+    outcomes = df[groups].assign(tp=actual_pos & pred_pos,
+                                 fp=actual_neg & pred_pos,
+                                 tn=actual_neg & pred_neg,
+                                 fn=actual_pos & pred_neg)
+
+    return outcomes.groupby(groups, as_index=False, observed=True).sum()
 
 
 # --------------------------------------------------
-def test_calc_metrics() -> None:
-    """ Test calc_metrics() """
+def calc_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    """ Caculate classification performance metrics from counts """
+
+    def ratio(num: pd.Series, denom: pd.Series) -> pd.Series:
+        return (num / denom).where(denom != 0)
 
-    true = np.array(['viral', 'non-viral'])
-    pred = np.array(['viral', 'viral'])
-    exp = Metrics(0, 1, 0, 1, 0., 1., 0.5, 2 / 3)
-    assert calc_metrics(true, pred) == exp
+    df['sensitivity'] = ratio(df['tp'], df['tp'] + df['fn'])
+    df['specificity'] = ratio(df['tn'], df['tn'] + df['fp'])
+    df['precision'] = ratio(df['tp'], df['tp'] + df['fp'])
+    df['f1'] = ratio(2 * df['precision'] * df['sensitivity'],
+                     df['precision'] + df['sensitivity'])
 
-    true = np.array(['viral', 'non-viral'])
-    pred = np.array(['non-viral', 'non-viral'])
-    exp = Metrics(1, 0, 1, 0, 1., 0., np.nan, np.nan)
-    assert_almost_equal(calc_metrics(true, pred), exp)
+    return df
 
 
 # --------------------------------------------------
-def get_lengthbin_metrics(df: pd.DataFrame) -> pd.DataFrame:
-    """ Get metrics for each length bin """
+def test_calc_metrics() -> None:
+    """ Test calc_metrics() """
 
-    out_df = pd.DataFrame(columns=[
-        'length_bin', 'tp', 'fp', 'tn', 'fn', 'f1', 'sensitivity',
-        'specificity', 'precision'
-    ])
-    for _, lengthbin_df in df.groupby('length_bin'):
-        metrics = calc_metrics(np.array(lengthbin_df['actual_class']),
-                               np.array(lengthbin_df['prediction']))
-
-        length_bin = lengthbin_df['length_bin'].unique()
-
-        new_row = pd.DataFrame({
-            'length_bin': length_bin,
-            'tp': metrics.tp,
-            'fp': metrics.fp,
-            'tn': metrics.tn,
-            'fn': metrics.fn,
-            'f1': metrics.f1,
-            'sensitivity': metrics.sensitivity,
-            'specificity': metrics.specificity,
-            'precision': metrics.precision
-        })
-
-        out_df = pd.concat([out_df, new_row])
+    in_df = pd.DataFrame({
+        'actual_class': ['viral', 'non-viral', 'viral', 'non-viral'],
+        'prediction': ['viral', 'viral', 'non-viral', 'non-viral'],
+        'tool': ['dvf', 'dvf', 'seeker', 'seeker']
+    })
 
-    return out_df
+    out_df = pd.DataFrame({
+        'tool': ['dvf', 'seeker'],
+        'tp': [1, 0],
+        'fp': [1, 0],
+        'tn': [0, 1],
+        'fn': [0, 1],
+        'sensitivity': [1., 0.],
+        'specificity': [0., 1.],
+        'precision': [0.5, np.nan],
+        'f1': [2 / 3, np.nan]
+    })
+
+    assert_frame_equal(calc_metrics(count_outcomes(in_df, ['tool'])), out_df)
 
 
 # --------------------------------------------------
 def get_tool_metrics(df: pd.DataFrame) -> pd.DataFrame:
     """ Get metrics for each tool per length bin """
 
-    out_df = pd.DataFrame(columns=[
+    metrics = calc_metrics(
+        count_outcomes(df, ['metagenome', 'tool', 'length_bin']))
+
+    return metrics[[
         'metagenome', 'tool', 'length_bin', 'tp', 'fp', 'tn', 'fn', 'f1',
         'sensitivity', 'specificity', 'precision'
-    ])
-    for _, tool_df in df.groupby(['metagenome', 'tool']):
-        tool_metrics = get_lengthbin_metrics(tool_df)
-
-        nrows = len(tool_metrics)
-        tool_metrics['tool'] = [tool_df['tool'].unique()[0]] * nrows
-        tool_metrics['metagenome'] = [tool_df['metagenome'].unique()[0]
-                                      ] * nrows
-
-        out_df = pd.concat([out_df, tool_metrics])
-
-    return out_df
+    ]]
 
 
 # --------------------------------------------------
@@ -7,11 +7,20 @@ Purpose: Select genome fragments for analysis
 
 import argparse
 import fnmatch
+import io
 import os
 import random
 import sys
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import accumulate
 from Bio import SeqIO
-from typing import NamedTuple
+from Bio.SeqRecord import SeqRecord
+from typing import (Dict, Iterator, List, NamedTuple, Optional, Set, TextIO,
+                    Tuple)
+
+# Fragment index written to each directory of fragment files
+INDEX_FILE = 'frags_index.tsv'
 
 
 class Args(NamedTuple):
@@ -21,6 +30,17 @@ class Args(NamedTuple):
     seed: bool
     out: str
     replace: bool
+    weighted: bool
+    batch: bool
+    counts: Optional[TextIO]
+
+
+# --------------------------------------------------
+class FileIndex(NamedTuple):
+    """ Location of each record in a fragment file """
+    ids: List[str]
+    offsets: List[int]
+    lengths: List[int]
 
 
 # --------------------------------------------------
@@ -56,11 +76,30 @@ def get_args() -> Args:
                         help='Randomly select files with replacement',
                         action='store_true')
 
+    parser.add_argument('-w',
+                        '--weighted',
+                        help='Select files weighted by number of fragments',
+                        action='store_true')
+
     parser.add_argument('-s',
                         '--seed',
                         help='Use seed to fix randomness',
                         action='store_true')
 
+    parser.add_argument('-b',
+                        '--batch',
+                        help='Select from every directory of fragment'
+                        ' files below dir',
+                        action='store_true')
+
+    parser.add_argument('-c',
+                        '--counts',
+                        help='Directories (relative to dir) and numbers of'
+                        ' fragments for --batch, tab-separated',
+                        metavar='FILE',
+                        type=argparse.FileType('rt'),
+                        default=None)
+
     args = parser.parse_args()
 
     if not os.path.isdir(args.dir):
@@ -70,8 +109,11 @@ def get_args() -> Args:
         parser.error(f'Number of fragments ({args.num})'
                      f' must be greater than 0')
 
-    return Args(args.dir, args.num, args.seed,
-                args.out, args.replace)
+    if args.counts and not args.batch:
+        parser.error('--counts can only be used with --batch')
+
+    return Args(args.dir, args.num, args.seed, args.out, args.replace,
+                args.weighted, args.batch, args.counts)
 
 
 # --------------------------------------------------
@@ -80,9 +122,33 @@ def main() -> None:
 
     args = get_args()
     in_dir = args.dir
-    num_frags = args.num
     out_dir = args.out
-    replacement = args.replace
+
+    if not args.batch:
+        n_rec, out_file = select_dir(in_dir, out_dir, args)
+        print(f'Done. Wrote {n_rec} records to {out_file}.')
+        return
+
+    selections = (get_counts(in_dir, args.counts)
+                  if args.counts else find_frag_dirs(in_dir, args.num))
+
+    # Each directory is selected as if by its own run
+    for sub_dir, num_frags in selections:
+        n_rec, out_file = select_dir(os.path.join(in_dir, sub_dir),
+                                     os.path.join(out_dir, sub_dir), args,
+                                     num_frags)
+        print(f'Wrote {n_rec} records to {out_file}.')
+
+    print(f'Done. Processed {len(selections)} '
+          f'director{"ies" if len(selections) != 1 else "y"}.')
+
+
+# --------------------------------------------------
+def select_dir(in_dir: str,
+               out_dir: str,
+               args: Args,
+               num_frags: Optional[int] = None) -> Tuple[int, str]:
+    """ Select fragments from directory, return number and output file """
 
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
@@ -92,15 +158,73 @@ def main() -> None:
 
     filenames = os.listdir(in_dir)
     filepaths = [os.path.join(in_dir, fn) for fn in filenames]
-    frag_files = [fn for fn in filepaths if fnmatch.fnmatch(fn, '*.fasta')]
+    frag_files = sorted(fn for fn in filepaths
+                        if fnmatch.fnmatch(fn, '*.fasta'))
 
-    chosen_frags = select_frags(frag_files, num_frags, replacement)
+    index = get_index(in_dir, frag_files)
+
+    chosen = select_frags(frag_files, index, num_frags or args.num,
+                          args.replace, args.weighted)
+
+    chosen_frags = read_frags(chosen, index)
 
     out_file = os.path.join(out_dir, 'selected_frags.fasta')
 
     n_rec = SeqIO.write(chosen_frags, out_file, 'fasta')
 
-    print(f'Done. Wrote {n_rec} records to {out_file}.')
+    return n_rec, out_file
+
+
+# --------------------------------------------------
+def find_frag_dirs(in_dir: str, num_frags: int) -> List[Tuple[str, int]]:
+    """ Find directories containing fragment files below in_dir """
+
+    frag_dirs = []
+
+    for dir_path, dir_names, filenames in os.walk(in_dir):
+        dir_names.sort()
+        if any(fnmatch.fnmatch(fn, '*.fasta') for fn in filenames):
+            frag_dirs.append((os.path.relpath(dir_path, in_dir), num_frags))
+
+    return frag_dirs
+
+
+# --------------------------------------------------
+def get_counts(in_dir: str, fh: TextIO) -> List[Tuple[str, int]]:
+    """ Read directories and numbers of fragments to select """
+
+    counts = []
+
+    for line in fh:
+        if not line.strip() or line.startswith('#'):
+            continue
+
+        try:
+            sub_dir, num = line.split()
+            num_frags = int(num)
+        except ValueError:
+            die(f'Invalid line in "{fh.name}": {line.rstrip()}')
+
+        if not os.path.isdir(os.path.join(in_dir, sub_dir)):
+            die(f'Directory "{sub_dir}" not found in "{in_dir}".')
+
+        if num_frags <= 0:
+            die(f'Number of fragments ({num_frags}) for "{sub_dir}"'
+                f' must be greater than 0')
+
+        counts.append((sub_dir, num_frags))
+
+    return counts
+
+
+# --------------------------------------------------
+def test_get_counts() -> None:
+    """ Test get_counts """
+
+    counts = io.StringIO('# Comment\narchaea/5\t3\n\nviral/50\t10\n')
+
+    assert get_counts('tests/inputs/chopped', counts) == [('archaea/5', 3),
+                                                          ('viral/50', 10)]
 
 
 # --------------------------------------------------
@@ -117,91 +241,410 @@ def die(msg='Error') -> None:
 
 
 # --------------------------------------------------
-def select_frags(frag_files, num_frags, replacement) -> list:
-    """ Make fragment selection """
+def get_index(in_dir: str, frag_files: List[str]) -> Dict[str, FileIndex]:
+    """ Read fragment index of directory, building it if out of date """
+
+    index_file = os.path.join(in_dir, INDEX_FILE)
+
+    if is_current(index_file, frag_files):
+        index = read_index(index_file)
+        return {fn: index[os.path.basename(fn)] for fn in frag_files}
+
+    index = {fn: index_fasta(fn) for fn in frag_files}
+
+    try:
+        write_index(index_file, index)
+    except OSError as err:
+        warn(f'Could not write fragment index "{index_file}": {err}')
+
+    return index
+
+
+# --------------------------------------------------
+def is_current(index_file: str, frag_files: List[str]) -> bool:
+    """ Check that index exists and is newer than all fragment files """
 
-    # Initially choose a number of files equal to number of fragments
-    chosen_files = select_files(frag_files, num_frags, replacement)
+    if not os.path.isfile(index_file):
+        return False
 
-    # Lists for chosen fragments and their id's for list comparison
-    chosen_frags = []
-    chosen_frag_ids = []
+    index_time = os.path.getmtime(index_file)
 
-    for fh in chosen_files:
+    if any(os.path.getmtime(fn) > index_time for fn in frag_files):
+        return False
 
-        # Randomly select fragments from each file, without repeats
-        chosen_frags, chosen_frag_ids, _ = check_frags(fh,
-                                                       chosen_frags,
-                                                       chosen_frag_ids)
+    with open(index_file, 'rt') as fh:
+        indexed = {line.split('\t', 1)[0] for line in fh}
+
+    return indexed - {'file'} == {os.path.basename(fn) for fn in frag_files}
+
+
+# --------------------------------------------------
+def index_fasta(filename: str) -> FileIndex:
+    """ Find id, byte offset, and length of each record in FASTA file """
 
-    # Use variable to track files whose fragments have not been exhausted
-    unexhausted_files = frag_files
+    index = FileIndex([], [], [])
+    offset = 0
 
-    while len(chosen_frag_ids) < num_frags and replacement:
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if index.offsets:
+                    index.lengths.append(offset - index.offsets[-1])
 
-        fh = random.choice(unexhausted_files)
+                title = line[1:].decode().split(None, 1)
+                index.ids.append(title[0] if title else '')
+                index.offsets.append(offset)
 
-        chosen_frags, chosen_frag_ids, exhausted = check_frags(fh,
-                                                               chosen_frags,
-                                                               chosen_frag_ids)
+            offset += len(line)
 
-        if exhausted:
-            unexhausted_files.remove(fh)
+    if index.offsets:
+        index.lengths.append(offset - index.offsets[-1])
 
-        if len(unexhausted_files) == 0:
-            warn(f'Directory does not have {num_frags} unique fragments. '
-                 f'Returning {len(chosen_frag_ids)} fragments.')
+    return index
+
+
+# --------------------------------------------------
+def test_index_fasta(tmp_path) -> None:
+    """ Test index_fasta """
+
+    fasta = tmp_path / 'test.fasta'
+    fasta.write_text('>frag_1 Fragment 1\nACGT\nAC\n>frag_2\nTT\n')
+
+    assert index_fasta(str(fasta)) == FileIndex(['frag_1', 'frag_2'],
+                                                [0, 27], [27, 11])
+
+    # Blank file written by chopper.py -b
+    fasta.write_text('\n')
+
+    assert index_fasta(str(fasta)) == FileIndex([], [], [])
+
+
+# --------------------------------------------------
+def write_index(index_file: str, index: Dict[str, FileIndex]) -> None:
+    """ Write fragment index as tab-separated file """
+
+    with open(index_file, 'wt') as out_fh:
+        print('\t'.join(['file', 'id', 'offset', 'length']), file=out_fh)
+
+        for filename, file_index in index.items():
+            basename = os.path.basename(filename)
+
+            # Files without records are kept, so they are not re-indexed
+            if not file_index.ids:
+                print(basename, file=out_fh)
+
+            for frag_id, offset, length in zip(*file_index):
+                print('\t'.join([basename, frag_id,
+                                 str(offset), str(length)]),
+                      file=out_fh)
+
+
+# --------------------------------------------------
+def read_index(index_file: str) -> Dict[str, FileIndex]:
+    """ Read fragment index, keyed by file name """
+
+    index: Dict[str, FileIndex] = {}
+
+    with open(index_file, 'rt') as fh:
+        next(fh)
+        for line in fh:
+            basename, *fields = line.rstrip('\n').split('\t')
+            file_index = index.setdefault(basename, FileIndex([], [], []))
+
+            if fields:
+                file_index.ids.append(fields[0])
+                file_index.offsets.append(int(fields[1]))
+                file_index.lengths.append(int(fields[2]))
+
+    return index
+
+
+# --------------------------------------------------
+def test_read_index(tmp_path) -> None:
+    """ Test index is the same after writing and reading """
+
+    index = {
+        'dir/a.fasta': FileIndex(['frag_1', 'frag_2'], [0, 26], [26, 10]),
+        'dir/b.fasta': FileIndex([], [], [])
+    }
+    index_file = str(tmp_path / INDEX_FILE)
+
+    write_index(index_file, index)
+
+    assert read_index(index_file) == {
+        'a.fasta': index['dir/a.fasta'],
+        'b.fasta': index['dir/b.fasta']
+    }
+
+
+# --------------------------------------------------
+def read_frags(chosen: List[Tuple[str, int]],
+               index: Dict[str, FileIndex]) -> List[SeqRecord]:
+    """ Read chosen records, given as file and record number """
+
+    by_file: Dict[str, List[int]] = defaultdict(list)
+    for filename, rec_num in chosen:
+        by_file[filename].append(rec_num)
+
+    records: Dict[Tuple[str, int], SeqRecord] = {}
+
+    for filename, rec_nums in by_file.items():
+        file_index = index[filename]
+
+        with open(filename, 'rb') as fh:
+            for rec_num in sorted(rec_nums):
+                fh.seek(file_index.offsets[rec_num])
+                text = fh.read(file_index.lengths[rec_num]).decode()
+                records[(filename, rec_num)] = SeqIO.read(
+                    io.StringIO(text), 'fasta')
+
+    return [records[frag] for frag in chosen]
+
+
+# --------------------------------------------------
+class Shuffler:
+    """ Draw numbers below n without replacement in constant time """
+
+    def __init__(self, n: int) -> None:
+
+        self.remaining = n
+
+        # Lazy Fisher-Yates shuffle, only storing swapped positions
+        self.swapped: Dict[int, int] = {}
+
+    def draw(self) -> int:
+        """ Draw next number """
+
+        i = random.randrange(self.remaining)
+        self.remaining -= 1
+        last = self.remaining
+
+        drawn = self.swapped.get(i, i)
+        self.swapped[i] = self.swapped.pop(last, last)
+
+        return drawn
+
+
+# --------------------------------------------------
+def test_shuffler() -> None:
+    """ Test Shuffler """
+
+    shuffler = Shuffler(100)
+
+    assert sorted(shuffler.draw() for _ in range(100)) == list(range(100))
+    assert shuffler.remaining == 0
+
+
+# --------------------------------------------------
+def select_frags(frag_files: List[str],
+                 index: Dict[str, FileIndex],
+                 num_frags: int,
+                 replacement: bool,
+                 weighted: bool = False) -> List[Tuple[str, int]]:
+    """ Make fragment selection, as file and record number """
+
+    counts = [len(index[fn].ids) for fn in frag_files]
+
+    chosen_frags: List[Tuple[str, int]] = []
+    chosen_frag_ids: Set[str] = set()
+
+    if not replacement:
+        # One fragment from each chosen file, not already chosen from
+        # another file
+        for file_num in select_files(counts, num_frags, weighted):
+            frag_file = frag_files[file_num]
+            rec_num = draw_unused(index[frag_file].ids, chosen_frag_ids)
+
+            if rec_num is not None:
+                chosen_frags.append((frag_file, rec_num))
+                chosen_frag_ids.add(index[frag_file].ids[rec_num])
+
+        # Too few files was already warned about by select_files()
+        if num_frags <= len(frag_files) and len(chosen_frags) < num_frags:
+            warn(f'Chosen files do not have {num_frags} unique fragments. '
+                 f'Returning {len(chosen_frags)} fragments.')
+
+        return chosen_frags
+
+    draws = draw_weighted(counts) if weighted else draw_uniform(counts)
+
+    for file_num, rec_num in draws:
+        frag_file = frag_files[file_num]
+        frag_id = index[frag_file].ids[rec_num]
+
+        # Files may share fragment id's
+        if frag_id in chosen_frag_ids:
+            continue
+
+        chosen_frags.append((frag_file, rec_num))
+        chosen_frag_ids.add(frag_id)
+
+        if len(chosen_frags) == num_frags:
             break
 
+    if len(chosen_frags) < num_frags:
+        warn(f'Directory does not have {num_frags} unique fragments. '
+             f'Returning {len(chosen_frags)} fragments.')
+
     return chosen_frags
 
 
 # --------------------------------------------------
-def select_files(frag_files, num_frags, replacement) -> list:
-    """ Make file selection"""
+def draw_unused(ids: List[str], chosen_ids: Set[str]) -> Optional[int]:
+    """ Draw number of a record whose id was not chosen, if any """
+
+    shuffler = Shuffler(len(ids))
+
+    while shuffler.remaining:
+        rec_num = shuffler.draw()
+        if ids[rec_num] not in chosen_ids:
+            return rec_num
+
+    return None
+
+
+# --------------------------------------------------
+def test_draw_unused() -> None:
+    """ Test draw_unused() """
+
+    assert draw_unused([], set()) is None
+    assert draw_unused(['x1', 'x2'], {'x1', 'x2'}) is None
+
+    for seed in range(20):
+        random.seed(seed)
+        assert draw_unused(['x1', 'x2', 'x3'], {'x1', 'x3'}) == 1
+
 
-    if replacement:
-        chosen_files = random.choices(frag_files, k=num_frags)
+# --------------------------------------------------
+def test_select_frags() -> None:
+    """ Test select_frags """
+
+    frag_files = ['a.fasta', 'b.fasta', 'c.fasta']
+    index = {
+        'a.fasta': FileIndex(['a1', 'a2', 'a3'], [0, 1, 2], [1, 1, 1]),
+        'b.fasta': FileIndex([], [], []),
+        'c.fasta': FileIndex(['c1', 'a1'], [0, 1], [1, 1])
+    }
+
+    for weighted in [False, True]:
+        random.seed(1)
+        chosen = select_frags(frag_files, index, 10, True, weighted)
+
+        # All unique fragment id's are returned once
+        assert len(chosen) == 4
+        assert len(set(chosen)) == 4
+        assert {index[fn].ids[rec] for fn, rec in chosen} == {
+            'a1', 'a2', 'a3', 'c1'
+        }
+
+        # Same seed gives same selection
+        random.seed(1)
+        assert select_frags(frag_files, index, 10, True, weighted) == chosen
+
+        random.seed(1)
+        assert len(select_frags(frag_files, index, 2, True, weighted)) == 2
+
+    # Without replacement, one fragment per file
+    index['c.fasta'] = FileIndex(['c1', 'c2'], [0, 1], [1, 1])
+    chosen = select_frags(frag_files, index, 3, False)
+    assert sorted(fn for fn, _ in chosen) == ['a.fasta', 'c.fasta']
+
+    # Without replacement, files sharing an id still give a fragment each
+    index = {
+        'a.fasta': FileIndex(['x1', 'a2'], [0, 1], [1, 1]),
+        'b.fasta': FileIndex(['x1', 'b2'], [0, 1], [1, 1])
+    }
+    for seed in range(50):
+        random.seed(seed)
+        chosen = select_frags(['a.fasta', 'b.fasta'], index, 2, False)
+        assert sorted(fn for fn, _ in chosen) == ['a.fasta', 'b.fasta']
+        assert len({index[fn].ids[rec] for fn, rec in chosen}) == 2
+
+    # Files whose ids were all chosen give no fragment
+    index = {
+        'a.fasta': FileIndex(['x1'], [0], [1]),
+        'b.fasta': FileIndex(['x1'], [0], [1])
+    }
+    assert len(select_frags(['a.fasta', 'b.fasta'], index, 2, False)) == 1
+
+    # Files without fragments are never chosen when weighted
+    assert select_files([0, 5, 0], 1, True) == [1]
+
+
+# --------------------------------------------------
+def select_files(counts: List[int], num_files: int,
+                 weighted: bool) -> List[int]:
+    """ Select numbers of files, without replacement """
 
-    elif not replacement and num_frags > len(frag_files):
-        warn(f'Number of requested fragments ({num_frags}) '
+    if num_files > len(counts):
+        warn(f'Number of requested fragments ({num_files}) '
              f'is greater than number of files.\n'
              f'Consider allowing --replacement. '
              f'Returning 1 fragment from all '
-             f'{len(frag_files)} files.')
+             f'{len(counts)} files.')
 
-        chosen_files = frag_files
+        return list(range(len(counts)))
 
-    else:
-        chosen_files = random.sample(frag_files, k=num_frags)
+    if not weighted:
+        return random.sample(range(len(counts)), k=num_files)
 
-    return chosen_files
+    # Weighted sampling without replacement, using the largest
+    # keys u^(1/w) of uniform random u (Efraimidis & Spirakis)
+    keys = [
+        random.random()**(1 / count) if count > 0 else -1.0
+        for count in counts
+    ]
+
+    return sorted(range(len(counts)), key=lambda i: keys[i],
+                  reverse=True)[:num_files]
 
 
 # --------------------------------------------------
-def check_frags(fh, chosen_frags, chosen_frag_ids) -> tuple:
-    """ Try to find unique frag in file """
+def draw_uniform(counts: List[int]) -> Iterator[Tuple[int, int]]:
+    """ Draw fragments from uniformly chosen files until all are drawn """
+
+    shufflers = [Shuffler(count) for count in counts]
+    available = [i for i, count in enumerate(counts) if count > 0]
+
+    while available:
+        pos = random.randrange(len(available))
+        file_num = available[pos]
+        shuffler = shufflers[file_num]
+
+        yield file_num, shuffler.draw()
 
-    frag_recs = []
+        # Exhausted file is swapped with last and removed
+        if shuffler.remaining == 0:
+            available[pos] = available[-1]
+            available.pop()
 
-    for seq_record in SeqIO.parse(fh, 'fasta'):
-        frag_recs.append(seq_record)
 
-    if all(frag.id in chosen_frag_ids for frag in frag_recs):
-        exhausted = True
-        return chosen_frags, chosen_frag_ids, exhausted
+# --------------------------------------------------
+def draw_weighted(counts: List[int]) -> Iterator[Tuple[int, int]]:
+    """ Draw fragments uniformly from all files until all are drawn """
+
+    # Position of each file's first fragment among all fragments
+    firsts = list(accumulate(counts, initial=0))
+    shuffler = Shuffler(firsts[-1])
 
-    exhausted = False
+    while shuffler.remaining > 0:
+        frag_num = shuffler.draw()
+        file_num = bisect_right(firsts, frag_num) - 1
 
-    chosen_frag = random.choice(frag_recs)
+        yield file_num, frag_num - firsts[file_num]
 
-    while chosen_frag.id in chosen_frag_ids:
-        chosen_frag = random.choice(frag_recs)
 
-    chosen_frags.append(chosen_frag)
-    chosen_frag_ids.append(chosen_frag.id)
+# --------------------------------------------------
+def test_draws() -> None:
+    """ Test draw_uniform and draw_weighted draw each fragment once """
+
+    counts = [3, 0, 1, 2]
+    frags = [(0, 0), (0, 1), (0, 2), (2, 0), (3, 0), (3, 1)]
 
-    return chosen_frags, chosen_frag_ids, exhausted
+    assert sorted(draw_uniform(counts)) == frags
+    assert sorted(draw_weighted(counts)) == frags
+    assert not list(draw_uniform([0, 0]))
+    assert not list(draw_weighted([0, 0]))
 
 
 # --------------------------------------------------
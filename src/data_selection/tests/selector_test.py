@@ -129,3 +129,72 @@ def test_warns_too_many() -> None:
     finally:
         if os.path.isdir(out_dir):
             shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_weighted_seed() -> None:
+    """ Weighted selection is reproducible with seed """
+
+    out_dir = 'out_test'
+    out_file = os.path.join(out_dir, 'selected_frags.fasta')
+    try:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+        outputs = []
+        for _ in range(2):
+            rv, out = getstatusoutput(f'{PRG} {TEST1} -n 5 -r -w -s'
+                                      f' -o {out_dir}')
+
+            assert rv == 0
+            assert out == (f'Done. Wrote 5 records to {out_file}.')
+            outputs.append(open(out_file).read())
+
+        assert outputs[0] == outputs[1]
+        assert outputs[0].count('>') == 5
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_batch() -> None:
+    """ Selects from a tree of directories """
+
+    out_dir = 'out_test'
+    counts_file = 'test_counts.tsv'
+    try:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+        with open(counts_file, 'wt') as out_fh:
+            print('archaea/5\t2\nbacteria/50\t3', file=out_fh)
+
+        rv, out = getstatusoutput(f'{PRG} tests/inputs/chopped -b -r -s'
+                                  f' -c {counts_file} -o {out_dir}')
+
+        assert rv == 0
+        assert out.splitlines() == [
+            f'Wrote 2 records to {out_dir}/archaea/5/selected_frags.fasta.',
+            f'Wrote 3 records to {out_dir}/bacteria/50/selected_frags.fasta.',
+            'Done. Processed 2 directories.'
+        ]
+        batch_out = open(f'{out_dir}/archaea/5/selected_frags.fasta').read()
+
+        # Same as selecting from the directory alone
+        rv, out = getstatusoutput(f'{PRG} {TEST1} -n 2 -r -s -o {out_dir}')
+
+        assert rv == 0
+        assert open(f'{out_dir}/selected_frags.fasta').read() == batch_out
+
+        # Counts require batch mode
+        rv, out = getstatusoutput(f'{PRG} {TEST1} -c {counts_file}')
+        assert rv != 0
+        assert out.lower().startswith('usage:')
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        if os.path.isfile(counts_file):
+            os.remove(counts_file)
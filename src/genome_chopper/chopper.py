@@ -6,21 +6,69 @@ Purpose: Chop a genome into simulated contigs
 """
 
 import argparse
+import io
+import multiprocessing as mp
 import os
+import struct
 import sys
-from typing import Dict, List, NamedTuple, TextIO, Tuple, TypedDict
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
-from collections import defaultdict
+from collections import deque
+from itertools import product
+from multiprocessing.pool import AsyncResult
+from typing import (BinaryIO, Deque, Iterator, List, NamedTuple, Optional,
+                    TextIO, Tuple, TypedDict, Union)
+import numpy as np
+
+# Line width of FASTA output
+WRAP = 60
+
+# Bases whose frequencies are annotated
+BASES = 'ACGT'
+
+# Number of bases read from a record at a time
+CHUNK_SIZE = 1_000_000
+
+# Lengths of k-mers whose canonical frequencies are computed
+KMER_SIZES = (2, 3, 4)
+
+# Number of k-mer positions counted at a time
+KMER_BATCH = 1_000_000
+
+# Size of .npy header, leaving room for the final number of rows
+NPY_HEADER_SIZE = 128
 
 
 class Args(NamedTuple):
     """ Command-line arguments """
     genome: List[TextIO]
     out_dir: str
-    length: int
-    overlap: int
+    length: List[int]
+    overlap: List[int]
     blank: bool
+    subdirs: bool
+    kmers: bool
+    jobs: int
+
+
+# --------------------------------------------------
+class Fragments(NamedTuple):
+    """ Formatted fragments of a sequence """
+    fasta: bytes
+    tsv: bytes
+    n_frags: int
+    kmers: Optional[np.ndarray] = None
+
+
+# Fragments, or fragments being chopped by a worker
+FragResult = Union[Fragments, AsyncResult]
+
+
+# --------------------------------------------------
+class SeqChunk(NamedTuple):
+    """ Piece of sequence read from a FASTA record """
+    rec_id: str
+    description: str
+    seq: bytes
+    first: bool
 
 
 # --------------------------------------------------
@@ -59,34 +107,71 @@ def get_args() -> Args:
 
     parser.add_argument('-l',
                         '--length',
-                        help='Segment length (b)',
+                        help='Segment length(s) (b)',
                         metavar='INT',
                         type=int,
-                        default='100')
+                        nargs='+',
+                        default=[100])
 
     parser.add_argument('-v',
                         '--overlap',
-                        help='Overlap length (b)',
+                        help='Overlap length (b), one for all'
+                        ' lengths or one per length',
                         metavar='INT',
                         type=int,
-                        default='10')
+                        nargs='+',
+                        default=[10])
 
     parser.add_argument('-b',
                         '--blank',
                         help='Write blank when sequence shorter than -l',
                         action='store_true')
 
+    parser.add_argument('-s',
+                        '--subdirs',
+                        help='Write output to subdirectory named by length'
+                        ' (always done for multiple lengths)',
+                        action='store_true')
+
+    parser.add_argument('-k',
+                        '--kmers',
+                        help='Write canonical k-mer frequencies'
+                        ' to _frags_kmers.npy',
+                        action='store_true')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='Number of worker processes',
+                        metavar='INT',
+                        type=int,
+                        default=1)
+
     args = parser.parse_args()
 
-    if args.length <= 0:
-        parser.error(f'length "{args.length}" must be greater than 0')
+    if args.jobs <= 0:
+        parser.error(f'jobs "{args.jobs}" must be greater than 0')
+
+    if len(args.overlap) == 1:
+        args.overlap = args.overlap * len(args.length)
+
+    if len(args.overlap) != len(args.length):
+        parser.error(f'number of overlaps ({len(args.overlap)}) must be 1'
+                     f' or number of lengths ({len(args.length)})')
+
+    for length, overlap in zip(args.length, args.overlap):
+        if length <= 0:
+            parser.error(f'length "{length}" must be greater than 0')
 
-    if args.overlap > args.length:
-        parser.error(f'overlap "{args.overlap}"'
-                     f' cannot be greater than length "{args.length}"')
+        if overlap >= length:
+            parser.error(f'overlap "{overlap}"'
+                         f' must be less than length "{length}"')
 
-    return Args(args.genome, args.out_dir, args.length,
-                args.overlap, args.blank)
+    if len(set(args.length)) != len(args.length):
+        parser.error(f'lengths {args.length} must be unique')
+
+    return Args(args.genome, args.out_dir, args.length, args.overlap,
+                args.blank, args.subdirs or len(args.length) > 1,
+                args.kmers, args.jobs)
 
 
 # --------------------------------------------------
@@ -108,108 +193,443 @@ def main() -> None:
 
     args = get_args()
     files = args.genome
-    out_dir = args.out_dir
-    length = args.length
-    overlap = args.overlap
     write_blank = args.blank
 
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
+    out_dirs = [
+        os.path.join(args.out_dir, str(length)) if args.subdirs else
+        args.out_dir for length in args.length
+    ]
+
+    for out_dir in out_dirs:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    # Chunks of all files and records are chopped in
+    # parallel, while output is written in input order
+    output = OutputQueue(args.jobs)
 
     for fh in files:
 
-        frag_recs = []
+        out_file_base = os.path.splitext(os.path.basename(fh.name))[0]
+
+        # Every length is chopped from a single read of the file
+        writers = [
+            FragmentWriter(os.path.join(out_dir, out_file_base), length,
+                           overlap, output, args.kmers)
+            for out_dir, length, overlap in zip(out_dirs, args.length,
+                                                args.overlap)
+        ]
 
-        for seq_record in SeqIO.parse(fh, "fasta"):
+        for chunk in read_chunks(fh):
+            for writer in writers:
+                if chunk.first:
+                    writer.start_record(chunk.rec_id, chunk.description)
+                writer.add_seq(chunk.seq)
 
-            seq_len = len(seq_record)
-            min_overlap = 2*length - seq_len
+        for writer in writers:
+            writer.close(write_blank)
 
-            if length > seq_len:
-                warn(f'Warning: length "{length}" greater than sequence'
-                     f' ({seq_record.id}) length ({seq_len}). Skipping.')
-                continue
-            if overlap < min_overlap:
-                warn(f'Warning: overlap "{overlap}" less than minimum'
-                     f'overlap: {min_overlap}\n\tminimum '
-                     f'overlap =  2 * length - seq_len '
-                     f'(2*{length}-{seq_len}={min_overlap}). Skipping.')
-                continue
+        fh.close()
 
-            for frags in chop(seq_record, length, overlap):
-                frag_recs.append(frags)
+    output.close()
 
-        out_file_base = os.path.splitext(os.path.basename(fh.name))[0]
-        out_file_fa = os.path.join(out_dir,  out_file_base + '_frags.fasta')
-        out_file_tsv = os.path.join(out_dir,  out_file_base + '_frags.tsv')
+    print(f'Done. Processed {len(files)} '
+          f'file{"s" if len(files)!= 1 else ""}.')
+
+
+# --------------------------------------------------
+def read_chunks(fh: TextIO,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[SeqChunk]:
+    """ Read FASTA records as chunks of at least chunk_size bases """
+
+    title: Optional[str] = None
+    lines: List[str] = []
+    n_bases = 0
+    first = True
+
+    for line in fh:
+        if line.startswith('>'):
+            if title is not None:
+                yield make_chunk(title, lines, first)
+            title = line[1:].rstrip()
+            lines = []
+            n_bases = 0
+            first = True
+
+        elif title is not None:
+            line = line.rstrip().replace(' ', '')
+            lines.append(line)
+            n_bases += len(line)
+
+            if n_bases >= chunk_size:
+                yield make_chunk(title, lines, first)
+                lines = []
+                n_bases = 0
+                first = False
+
+    if title is not None:
+        yield make_chunk(title, lines, first)
+
+
+# --------------------------------------------------
+def make_chunk(title: str, lines: List[str], first: bool) -> SeqChunk:
+    """ Make sequence chunk from record title and sequence lines """
+
+    rec_id = title.split(None, 1)[0] if title else ''
+
+    return SeqChunk(rec_id, title, ''.join(lines).encode(), first)
+
+
+# --------------------------------------------------
+def test_read_chunks():
+    """ Test read_chunks """
+
+    fasta = io.StringIO('>seq1 First seq\nACGT\nAC\n>seq2\n>seq3 \nTTTT\n')
+
+    assert list(read_chunks(fasta)) == [
+        SeqChunk('seq1', 'seq1 First seq', b'ACGTAC', True),
+        SeqChunk('seq2', 'seq2', b'', True),
+        SeqChunk('seq3', 'seq3', b'TTTT', True)
+    ]
+
+    fasta.seek(0)
+
+    assert list(read_chunks(fasta, 4)) == [
+        SeqChunk('seq1', 'seq1 First seq', b'ACGT', True),
+        SeqChunk('seq1', 'seq1 First seq', b'AC', False),
+        SeqChunk('seq2', 'seq2', b'', True),
+        SeqChunk('seq3', 'seq3', b'TTTT', True),
+        SeqChunk('seq3', 'seq3', b'', False)
+    ]
+
+
+# --------------------------------------------------
+class OutputQueue:
+    """ Run chop() in a process pool, writing results in order """
+
+    def __init__(self, jobs: int = 1) -> None:
+
+        self.pool = mp.Pool(jobs) if jobs > 1 else None
+
+        # Bound number of chopped chunks held in memory
+        self.max_queued = 2 * jobs
+        self.queued: Deque[Tuple['FragmentWriter',
+                                 Optional[FragResult]]] = deque()
+
+    def submit(self, *args) -> FragResult:
+        """ Start chopping fragments """
+
+        if self.pool is None:
+            return chop(*args)
+
+        return self.pool.apply_async(chop, args)
+
+    def put(self, writer: 'FragmentWriter',
+            result: Optional[FragResult]) -> None:
+        """ Queue result to be written, or writer to be closed if None """
+
+        self.queued.append((writer, result))
+
+        while len(self.queued) > self.max_queued:
+            self.pop()
+
+    def pop(self) -> None:
+        """ Write oldest result once it is ready """
+
+        writer, result = self.queued.popleft()
+
+        if result is None:
+            writer.finish()
+        elif isinstance(result, Fragments):
+            writer.write(result)
+        else:
+            writer.write(result.get())
+
+    def close(self) -> None:
+        """ Write all remaining results and shut down pool """
+
+        while self.queued:
+            self.pop()
 
-        if len(frag_recs) > 0:
-            n_rec = SeqIO.write(frag_recs, out_file_fa, "fasta")
-            print(f'Wrote {n_rec} records to "{out_file_fa}".')
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
 
-        if len(frag_recs) == 0:
-            if write_blank:
-                with open(out_file_fa, 'wt') as out_fh:
+
+# --------------------------------------------------
+class FragmentWriter:
+    """ Chop sequences, writing fragments as they are produced """
+
+    def __init__(self,
+                 out_file_base: str,
+                 frag_len: int,
+                 overlap: int,
+                 output: OutputQueue,
+                 kmers: bool = False) -> None:
+
+        self.fasta_file = out_file_base + '_frags.fasta'
+        self.tsv_file = out_file_base + '_frags.tsv'
+        self.kmer_file = out_file_base + '_frags_kmers.npy'
+        self.frag_len = frag_len
+        self.overlap = overlap
+        self.output = output
+        self.kmers = kmers
+        self.fasta_fh: Optional[BinaryIO] = None
+        self.tsv_fh: Optional[BinaryIO] = None
+        self.kmer_fh: Optional[BinaryIO] = None
+        self.n_written = 0
+        self.write_blank = False
+
+        # State of current record
+        self.rec_id: Optional[str] = None
+        self.description = ''
+        self.seq_len = 0
+        self.n_frags = 0
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.offset = 0
+        self.next_start = 0
+        self.pending: Optional[FragResult] = None
+
+    def start_record(self, rec_id: str, description: str) -> None:
+        """ Finish previous record and start a new one """
+
+        self.end_record()
+
+        self.rec_id = rec_id
+        self.description = description
+        self.seq_len = 0
+        self.n_frags = 0
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.offset = 0
+        self.next_start = 0
+        self.pending = None
+
+    def add_seq(self, seq_chunk: bytes) -> None:
+        """ Chop all fragments completed by next chunk of sequence """
+
+        seq = np.concatenate(
+            (self.buffer, np.frombuffer(seq_chunk, dtype=np.uint8)))
+        self.seq_len += len(seq_chunk)
+
+        first = self.next_start - self.offset
+        starts, _ = get_positions(len(seq) - first, self.frag_len,
+                                  self.overlap)
+        starts += first
+
+        if len(starts) > 0:
+            # Only send the sequence covered by fragments
+            lo, hi = int(starts[0]), int(starts[-1]) + self.frag_len
+            frags = self.output.submit(seq[lo:hi], starts - lo,
+                                       self.frag_len, str(self.rec_id),
+                                       self.description, self.n_frags + 1,
+                                       self.offset + lo, self.kmers)
+
+            # A lone fragment is held back, since a sequence
+            # that only fits one fragment is skipped
+            if self.n_frags == 0 and len(starts) == 1:
+                self.pending = frags
+            else:
+                if self.pending is not None:
+                    self.output.put(self, self.pending)
+                    self.pending = None
+                self.output.put(self, frags)
+
+            self.n_frags += len(starts)
+            self.next_start = (self.offset + int(starts[-1]) + self.frag_len -
+                               self.overlap)
+
+        # Only keep sequence that may be part of upcoming fragments
+        cut = min(self.next_start - self.offset, len(seq))
+        self.buffer = seq[cut:]
+        self.offset += cut
+
+    def end_record(self) -> None:
+        """ Warn if record was skipped """
+
+        if self.rec_id is None:
+            return
+
+        length = self.frag_len
+        seq_len = self.seq_len
+        min_overlap = 2 * length - seq_len
+
+        if self.n_frags == 0:
+            warn(f'Warning: length "{length}" greater than sequence'
+                 f' ({self.rec_id}) length ({seq_len}). Skipping.')
+        elif self.n_frags == 1:
+            warn(f'Warning: overlap "{self.overlap}" less than minimum'
+                 f'overlap: {min_overlap}\n\tminimum '
+                 f'overlap =  2 * length - seq_len '
+                 f'(2*{length}-{seq_len}={min_overlap}). Skipping.')
+
+        self.rec_id = None
+        self.pending = None
+        self.buffer = np.empty(0, dtype=np.uint8)
+
+    def write(self, frags: Fragments) -> None:
+        """ Write fragments, opening output files if needed """
+
+        if self.fasta_fh is None or self.tsv_fh is None:
+            self.fasta_fh = open(self.fasta_file, 'wb')
+            self.tsv_fh = open(self.tsv_file, 'wb')
+            header = ['id', 'name', *SeqAnnotations.__annotations__]
+            self.tsv_fh.write(('\t'.join(header) + '\n').encode())
+
+            # Header is rewritten once the number of rows is known
+            if self.kmers:
+                self.kmer_fh = open(self.kmer_file, 'wb')
+                self.kmer_fh.write(get_npy_header(0, len(get_kmer_names())))
+
+        self.fasta_fh.write(frags.fasta)
+        self.tsv_fh.write(frags.tsv)
+        if self.kmer_fh is not None and frags.kmers is not None:
+            self.kmer_fh.write(frags.kmers.tobytes())
+        self.n_written += frags.n_frags
+
+    def close(self, write_blank: bool) -> None:
+        """ Finish last record, and close once all output is written """
+
+        self.end_record()
+        self.write_blank = write_blank
+        self.output.put(self, None)
+
+    def finish(self) -> None:
+        """ Close output files and report number of fragments """
+
+        if self.fasta_fh is not None and self.tsv_fh is not None:
+            self.fasta_fh.close()
+            self.tsv_fh.close()
+
+            if self.kmer_fh is not None:
+                self.kmer_fh.seek(0)
+                self.kmer_fh.write(
+                    get_npy_header(self.n_written, len(get_kmer_names())))
+                self.kmer_fh.close()
+
+        elif self.write_blank:
+            for out_file in [self.fasta_file, self.tsv_file]:
+                with open(out_file, 'wt') as out_fh:
                     print('', file=out_fh)
-                print(f'Wrote 0 records to "{out_file_fa}".')
 
-        write_annotations(frag_recs, out_file_tsv, write_blank)
+            if self.kmers:
+                with open(self.kmer_file, 'wb') as kmer_fh:
+                    kmer_fh.write(get_npy_header(0, len(get_kmer_names())))
 
-    print(f'Done. Processed {len(files)} '
-          f'file{"s" if len(files)!= 1 else ""}.')
+        if self.n_written > 0 or self.write_blank:
+            print(f'Wrote {self.n_written} records to "{self.fasta_file}".')
 
 
 # --------------------------------------------------
-def chop(record: SeqRecord, frag_len: int, overlap: int) -> List[SeqRecord]:
-    """ Chop sequence from record """
+def chop(seq: np.ndarray,
+         starts: np.ndarray,
+         frag_len: int,
+         rec_id: str,
+         description: str,
+         first_num: int,
+         offset: int,
+         kmers: bool = False) -> Fragments:
+    """
+    Chop fragments from sequence
 
-    starts, stops = get_positions(len(record.seq), frag_len, overlap)
+    Fragments are numbered from `first_num`, and `offset` is
+    the position of `seq` in the record. If `kmers` is set,
+    k-mer frequencies of the fragments are also computed.
+    """
 
-    frag_recs = []
-    n_frag = 0
+    stops = starts + frag_len - 1
 
-    for start, stop in zip(starts, stops):
-        n_frag += 1
-        frag = record.seq[start: stop+1]
+    freqs = get_base_freqs(seq, starts, stops).tolist()
+    frag_seqs = get_frag_seqs(seq, starts, frag_len)
 
-        freqs = find_tetra(frag)
+    fasta = []
+    tsv = []
 
-        frag_annotations = SeqAnnotations(parent_id=record.id,
-                                          parent_name=record.description,
-                                          frag_start=start + 1,
-                                          frag_end=stop + 1,
-                                          a_pct=freqs['A'],
-                                          c_pct=freqs['C'],
-                                          g_pct=freqs['G'],
-                                          t_pct=freqs['T']
-                                          )
+    for n_frag, (start, stop, freq, frag_seq) in enumerate(
+            zip((starts + offset).tolist(), (stops + offset).tolist(), freqs,
+                frag_seqs), first_num):
 
-        frag_rec = SeqRecord(frag, id=f'frag_{n_frag}_{record.id}',
-                             description=f'Fragment {n_frag}'
-                                         f' of {record. description}',
-                                         annotations=frag_annotations
-                             )
+        frag_id = f'frag_{n_frag}_{rec_id}'
+        frag_name = f'Fragment {n_frag} of {description}'
 
-        frag_recs.append(frag_rec)
+        fasta.append(f'>{frag_id} {frag_name}\n'.encode())
+        fasta.append(frag_seq.tobytes())
 
-    return frag_recs
+        tsv.append('\t'.join(
+            map(str, [
+                frag_id, frag_name, rec_id, description, start + 1, stop + 1,
+                *freq
+            ])) + '\n')
+
+    kmer_freqs = get_kmer_freqs(seq, starts, frag_len) if kmers else None
+
+    return Fragments(b''.join(fasta), ''.join(tsv).encode(), len(starts),
+                     kmer_freqs)
 
 
 # --------------------------------------------------
-def get_positions(length: int, frag: int, overlap: int) -> Tuple:
-    """ Get starting and stopping positions """
+def test_fragment_writer(tmp_path):
+    """ Test FragmentWriter gives same fragments regardless of chunking """
+
+    seq = b'ACGTTGCAAC' * 20
+
+    outputs = []
+    for chunk_size, jobs in [(len(seq), 1), (7, 1), (1, 1), (7, 2)]:
+        out_base = str(tmp_path / f'chunk_{chunk_size}_{jobs}')
+        output = OutputQueue(jobs)
+        writer = FragmentWriter(out_base, 12, 5, output)
+        writer.start_record('seq1', 'seq1 Test')
+        for i in range(0, len(seq), chunk_size):
+            writer.add_seq(seq[i:i + chunk_size])
+
+        writer.close(False)
+        output.close()
+        assert writer.n_written == 27
+        outputs.append((open(out_base + '_frags.fasta').read(),
+                        open(out_base + '_frags.tsv').read()))
+
+    assert outputs[0] == outputs[1] == outputs[2] == outputs[3]
+
+    # K-mer frequencies have a row per fragment
+    out_base = str(tmp_path / 'kmers')
+    output = OutputQueue()
+    writer = FragmentWriter(out_base, 12, 5, output, kmers=True)
+    writer.start_record('seq1', 'seq1 Test')
+    writer.add_seq(seq)
+    writer.close(False)
+    output.close()
+    kmers = np.load(out_base + '_frags_kmers.npy')
+    assert kmers.shape == (27, len(get_kmer_names()))
+    assert kmers.tolist()[0] == get_kmer_freqs(
+        np.frombuffer(seq, dtype=np.uint8), np.array([0]), 12).tolist()[0]
+
+    fasta, tsv = outputs[0]
+    assert fasta.startswith('>frag_1_seq1 Fragment 1 of seq1 Test\n'
+                            'ACGTTGCAACAC\n'
+                            '>frag_2_seq1 Fragment 2 of seq1 Test\n'
+                            'AACACGTTGCAA\n')
+    assert tsv.splitlines()[-1] == ('frag_27_seq1\tFragment 27 of seq1 Test'
+                                    '\tseq1\tseq1 Test\t183\t194'
+                                    '\t0.25\t0.25\t0.25\t0.25')
+
+    # Sequence that only fits one fragment is skipped
+    out_base = str(tmp_path / 'short')
+    output = OutputQueue()
+    writer = FragmentWriter(out_base, 12, 5, output)
+    writer.start_record('seq1', 'seq1')
+    writer.add_seq(seq[:15])
+    writer.close(False)
+    output.close()
+    assert writer.n_written == 0
+    assert not os.path.isfile(out_base + '_frags.fasta')
 
-    starts = [0]
-    stops = [frag-1]
 
-    stop = stops[-1]
-    while stop < length - 1:
-        start = starts[-1] + frag - overlap
-        stop = start + frag - 1
+# --------------------------------------------------
+def get_positions(length: int, frag: int,
+                  overlap: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Get starting and stopping positions """
 
-        if stop <= length - 1:
-            starts.append(start)
-            stops.append(stop)
+    starts = np.arange(0, length - frag + 1, frag - overlap)
+    stops = starts + frag - 1
 
     return (starts, stops)
 
@@ -218,62 +638,258 @@ def get_positions(length: int, frag: int, overlap: int) -> Tuple:
 def test_get_positions():
     """ Test get_positions """
 
-    assert get_positions(4, 2, 1) == ([0, 1, 2], [1, 2, 3])
-    assert get_positions(4, 2, 0) == ([0, 2], [1, 3])
-    assert get_positions(4, 3, 2) == ([0, 1], [2, 3])
-    assert get_positions(5, 4, 3) == ([0, 1], [3, 4])
-    assert get_positions(5, 3, 2) == ([0, 1, 2], [2, 3, 4])
-    assert get_positions(5, 3, 1) == ([0, 2], [2, 4])
-    assert get_positions(5, 2, 1) == ([0, 1, 2, 3], [1, 2, 3, 4])
-    assert get_positions(5, 2, 0) == ([0, 2], [1, 3])
+    def positions(length: int, frag: int, overlap: int) -> Tuple[List, List]:
+        starts, stops = get_positions(length, frag, overlap)
+        return (starts.tolist(), stops.tolist())
 
+    assert positions(4, 2, 1) == ([0, 1, 2], [1, 2, 3])
+    assert positions(4, 2, 0) == ([0, 2], [1, 3])
+    assert positions(4, 3, 2) == ([0, 1], [2, 3])
+    assert positions(5, 4, 3) == ([0, 1], [3, 4])
+    assert positions(5, 3, 2) == ([0, 1, 2], [2, 3, 4])
+    assert positions(5, 3, 1) == ([0, 2], [2, 4])
+    assert positions(5, 2, 1) == ([0, 1, 2, 3], [1, 2, 3, 4])
+    assert positions(5, 2, 0) == ([0, 2], [1, 3])
 
-# --------------------------------------------------
-def find_tetra(seq: str) -> Dict[str, float]:
-    """ Calculate Tetranucleotide Frequency """
 
-    counts: Dict[str, int] = defaultdict(int)
-    freqs: Dict[str, float] = defaultdict(float)
+# --------------------------------------------------
+def get_base_freqs(seq: np.ndarray, starts: np.ndarray,
+                   stops: np.ndarray) -> np.ndarray:
+    """ Calculate base frequencies of fragments using prefix sums """
 
-    for base in seq:
-        counts[base.upper()] += 1
+    frag_lens = stops - starts + 1
+    freqs = np.empty((len(starts), len(BASES)))
 
-    for base, count in counts.items():
-        freqs[base] = count / len(seq)
+    for i, base in enumerate(BASES):
+        is_base = (seq == ord(base)) | (seq == ord(base.lower()))
+        counts = np.concatenate(([0], np.cumsum(is_base)))
+        freqs[:, i] = (counts[stops + 1] - counts[starts]) / frag_lens
 
     return freqs
 
 
 # --------------------------------------------------
-def test_find_tetra():
-    """ Test find_tetra """
+def test_get_base_freqs():
+    """ Test get_base_freqs """
+
+    def freqs(seq: str) -> List[List[float]]:
+        seq_arr = np.frombuffer(seq.encode(), dtype=np.uint8)
+        starts, stops = np.array([0]), np.array([len(seq) - 1])
+        return get_base_freqs(seq_arr, starts, stops).tolist()
+
+    assert freqs('A') == [[1, 0, 0, 0]]
+    assert freqs('C') == [[0, 1, 0, 0]]
+    assert freqs('G') == [[0, 0, 1, 0]]
+    assert freqs('t') == [[0, 0, 0, 1]]
+    assert freqs('N') == [[0, 0, 0, 0]]
+    assert freqs('ACCGGGTTTT') == [[0.1, 0.2, 0.3, 0.4]]
+
+    # Multiple fragments from the same sequence
+    seq_arr = np.frombuffer(b'AACCGGTT', dtype=np.uint8)
+    assert get_base_freqs(seq_arr, np.array([0, 2, 4]),
+                          np.array([3, 5, 7])).tolist() == [[.5, .5, 0, 0],
+                                                            [0, .5, .5, 0],
+                                                            [0, 0, .5, .5]]
+
+
+# --------------------------------------------------
+def get_frag_seqs(seq: np.ndarray, starts: np.ndarray,
+                  frag_len: int) -> np.ndarray:
+    """ Get wrapped FASTA sequence lines of each fragment """
+
+    windows = np.lib.stride_tricks.sliding_window_view(seq, frag_len)[starts]
+
+    # Insert a newline after each full line, and at the end
+    newlines = [*range(WRAP, frag_len, WRAP), frag_len]
+
+    return np.insert(windows, newlines, ord('\n'), axis=1)
+
+
+# --------------------------------------------------
+def test_get_frag_seqs():
+    """ Test get_frag_seqs """
+
+    seq = np.frombuffer(b'ACGTACGT', dtype=np.uint8)
+
+    frag_seqs = get_frag_seqs(seq, np.array([0, 4]), 4)
+    assert [row.tobytes() for row in frag_seqs] == [b'ACGT\n', b'ACGT\n']
+
+    seq = np.frombuffer(b'A' * 60 + b'C' * 70, dtype=np.uint8)
+
+    frag_seqs = get_frag_seqs(seq, np.array([0, 10]), 120)
+    assert [row.tobytes() for row in frag_seqs] == [
+        b'A' * 60 + b'\n' + b'C' * 60 + b'\n',
+        b'A' * 50 + b'C' * 10 + b'\n' + b'C' * 60 + b'\n'
+    ]
+
+
+# --------------------------------------------------
+def get_kmer_columns(k: int) -> np.ndarray:
+    """ Get column of the canonical form of each 2-bit encoded k-mer """
+
+    codes = np.arange(4**k)
+    shifts = 2 * np.arange(k)
+
+    # Complement of base i is 3 - i, and reversal swaps digit order
+    rev_comp = (((3 - (codes[:, None] >> shifts)) & 3) <<
+                shifts[::-1]).sum(axis=1)
+
+    _, columns = np.unique(np.minimum(codes, rev_comp), return_inverse=True)
+
+    return columns
+
+
+# --------------------------------------------------
+def get_kmer_names() -> List[str]:
+    """ Get names of k-mer frequency columns """
+
+    names: List[str] = []
+    for k in KMER_SIZES:
+        kmers = [''.join(kmer) for kmer in product(BASES, repeat=k)]
+        columns = get_kmer_columns(k)
+        names.extend(kmers[columns.tolist().index(i)]
+                     for i in range(columns.max() + 1))
+
+    return names
+
+
+# --------------------------------------------------
+def test_get_kmer_names():
+    """ Test get_kmer_names """
+
+    names = get_kmer_names()
+
+    assert len(names) == 10 + 32 + 136
+    assert names[:10] == [
+        'AA', 'AC', 'AG', 'AT', 'CA', 'CC', 'CG', 'GA', 'GC', 'TA'
+    ]
+    assert names[10] == 'AAA'
+    assert names[-1] == 'TTAA'
+
+
+# --------------------------------------------------
+def get_kmer_freqs(seq: np.ndarray, starts: np.ndarray,
+                   frag_len: int) -> np.ndarray:
+    """
+    Calculate canonical k-mer frequencies of fragments
+
+    K-mers are 2-bit encoded with a rolling shift, and any
+    k-mer containing a base other than ACGT is not counted.
+    """
 
-    assert find_tetra('') == {}
-    assert find_tetra('A') == {'A': 1}
-    assert find_tetra('C') == {'C': 1}
-    assert find_tetra('G') == {'G': 1}
-    assert find_tetra('T') == {'T': 1}
-    assert find_tetra('ACCGGGTTTT') == {'A': 0.1, 'C': 0.2, 'G': 0.3, 'T': 0.4}
+    lookup = np.full(256, 4, dtype=np.int64)
+    for i, base in enumerate(BASES):
+        lookup[ord(base)] = lookup[ord(base.lower())] = i
+
+    bases = lookup[seq]
+    is_valid = bases < 4
+    bases[~is_valid] = 0
+
+    codes = bases
+    valid = is_valid
+    freqs = []
+
+    for k in range(1, max(KMER_SIZES) + 1):
+        if k > 1:
+            codes = (codes[:-1] << 2) | bases[k - 1:]
+            valid = valid[:-1] & is_valid[k - 1:]
+
+        if k not in KMER_SIZES:
+            continue
+
+        columns = get_kmer_columns(k)
+        n_cols = columns.max() + 1
+        n_kmers = frag_len - k + 1
+
+        # Invalid k-mers are counted in an extra column that is dropped
+        kmer_cols = np.where(valid, columns[codes], n_cols)
+        counts = np.zeros((len(starts), n_cols), dtype=np.int64)
+
+        batch = max(1, KMER_BATCH // max(n_kmers, n_cols))
+        for lo in range(0, len(starts) if n_kmers > 0 else 0, batch):
+            batch_starts = starts[lo:lo + batch]
+            windows = kmer_cols[batch_starts[:, None] + np.arange(n_kmers)]
+            rows = np.arange(len(batch_starts))[:, None] * (n_cols + 1)
+            counts[lo:lo + batch] = np.bincount(
+                (windows + rows).ravel(),
+                minlength=len(batch_starts) * (n_cols + 1)).reshape(
+                    -1, n_cols + 1)[:, :n_cols]
+
+        totals = counts.sum(axis=1, keepdims=True)
+        freqs.append(counts / np.maximum(totals, 1))
+
+    return np.hstack(freqs).astype(np.float32)
+
+
+# --------------------------------------------------
+def test_get_kmer_freqs():
+    """ Test get_kmer_freqs """
+
+    names = get_kmer_names()
+
+    def freqs(seq: str) -> dict:
+        seq_arr = np.frombuffer(seq.encode(), dtype=np.uint8)
+        row = get_kmer_freqs(seq_arr, np.array([0]), len(seq))[0]
+        return {
+            name: freq
+            for name, freq in zip(names, row.tolist()) if freq != 0
+        }
+
+    assert freqs('AAAA') == {'AA': 1, 'AAA': 1, 'AAAA': 1}
+
+    # Reverse complements are counted together
+    assert freqs('TTTT') == freqs('AAAA')
+    assert freqs('ACGG') == freqs('ccgt')
+    third = np.float32(1 / 3)
+    assert freqs('ACGG') == {
+        'AC': third,
+        'CG': third,
+        'CC': third,
+        'ACG': 0.5,
+        'CCG': 0.5,
+        'ACGG': 1
+    }
+
+    # K-mers containing N are skipped
+    assert freqs('AANAA') == {'AA': 1}
+    assert freqs('NNNN') == {}
+
+    # Multiple fragments from the same sequence
+    seq_arr = np.frombuffer(b'AAAACCCC', dtype=np.uint8)
+    kmers = get_kmer_freqs(seq_arr, np.array([0, 4]), 4)
+    assert kmers.shape == (2, len(names))
+    assert kmers[0, names.index('AAAA')] == 1
+    assert kmers[1, names.index('CCCC')] == 1
 
 
 # --------------------------------------------------
-def write_annotations(frag_recs, out_file, write_blank):
-    """ Write fragment annotations to .tsv """
+def get_npy_header(n_rows: int, n_cols: int) -> bytes:
+    """ Make fixed size .npy header for a float32 matrix """
 
-    if len(frag_recs) != 0:
+    header = (f"{{'descr': '<f4', 'fortran_order': False, "
+              f"'shape': ({n_rows}, {n_cols}), }}")
 
-        with open(out_file, 'wt') as out_fh:
-            print('id', 'name', *frag_recs[0].annotations.keys(),
-                  sep='\t', file=out_fh)
+    # Magic string, version 1.0, and header length take 10 bytes
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+# --------------------------------------------------
+def test_get_npy_header(tmp_path):
+    """ Test get_npy_header """
 
-            for rec in frag_recs:
-                print(rec.id, rec.description, *rec.annotations.values(),
-                      sep='\t', file=out_fh)
+    out_file = str(tmp_path / 'test.npy')
+    matrix = np.arange(6, dtype=np.float32).reshape(2, 3)
 
-    elif len(frag_recs) == 0 and write_blank:
+    with open(out_file, 'wb') as out_fh:
+        header = get_npy_header(2, 3)
+        assert len(header) == NPY_HEADER_SIZE
+        out_fh.write(header)
+        out_fh.write(matrix.tobytes())
 
-        with open(out_file, 'wt') as out_fh:
-            print('', file=out_fh)
+    assert np.load(out_file).tolist() == matrix.tolist()
 
 
 # --------------------------------------------------
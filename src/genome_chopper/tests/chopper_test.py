@@ -5,6 +5,7 @@ import platform
 import os
 import re
 import shutil
+import numpy as np
 
 PRG = './chopper.py'
 RUN = f'python {PRG}' if platform.system() == 'Windows' else PRG
@@ -144,6 +145,69 @@ def test_multi_file() -> None:
             shutil.rmtree(out_dir)
 
 
+# --------------------------------------------------
+def test_jobs() -> None:
+    """ Parallel run gives same output as serial run """
+
+    out_dirs = ['out_test', 'out_test_jobs']
+
+    try:
+        for out_dir in out_dirs:
+            if os.path.isdir(out_dir):
+                shutil.rmtree(out_dir)
+
+        rv, out = getstatusoutput(f'{RUN} -l 6 -v 3 -o'
+                                  f' {out_dirs[0]} {TEST1} {TEST2}')
+        assert rv == 0
+
+        rv, out_jobs = getstatusoutput(f'{RUN} -l 6 -v 3 -j 2 -o'
+                                       f' {out_dirs[1]} {TEST1} {TEST2}')
+        assert rv == 0
+        assert out_jobs == out.replace('out_test/', 'out_test_jobs/')
+
+        for out_file in ['input1_frags.fasta', 'input1_frags.tsv',
+                         'input2_frags.fasta', 'input2_frags.tsv']:
+            files = [os.path.join(out_dir, out_file) for out_dir in out_dirs]
+            assert open(files[0]).read() == open(files[1]).read()
+
+        # Number of jobs must be positive
+        rv, out = getstatusoutput(f'{RUN} -j 0 {TEST1}')
+        assert rv != 0
+        assert out.lower().startswith('usage:')
+
+    finally:
+        for out_dir in out_dirs:
+            if os.path.isdir(out_dir):
+                shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_kmers() -> None:
+    """ Writes k-mer frequencies alongside fragments """
+
+    out_dir = "out_test"
+
+    try:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+        rv, _ = getstatusoutput(f'{RUN} -l 6 -v 3 -k -o {out_dir} {TEST2}')
+
+        assert rv == 0
+        kmers = np.load(os.path.join(out_dir, 'input2_frags_kmers.npy'))
+        assert kmers.shape == (4, 178)
+        assert kmers.dtype == np.float32
+
+        # Frequencies of each k sum to 1
+        assert np.allclose(kmers[:, :10].sum(axis=1), 1)
+        assert np.allclose(kmers[:, 10:42].sum(axis=1), 1)
+        assert np.allclose(kmers[:, 42:].sum(axis=1), 1)
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
 # --------------------------------------------------
 def test_blank_out() -> None:
     """ Outputs blank file for short sequence"""
@@ -166,3 +230,48 @@ def test_blank_out() -> None:
     finally:
         if os.path.isdir(out_dir):
             shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_bad_overlap_count() -> None:
+    """ Dies when number of overlaps does not match lengths """
+
+    rv, out = getstatusoutput(f'{RUN} {TEST1} -l 6 8 10 -v 1 2')
+    assert rv != 0
+    assert out.lower().startswith('usage:')
+    assert re.search(r'number of overlaps \(2\)', out)
+
+
+# --------------------------------------------------
+def test_multi_length() -> None:
+    """ Runs with multiple lengths, each in its own subdirectory """
+
+    out_dir = "out_test"
+
+    try:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+        rv, out = getstatusoutput(f'{RUN} -l 6 4 -v 3 0 -o'
+                                  f' {out_dir} {TEST2}')
+
+        assert rv == 0
+        assert out == ('Wrote 4 records to "out_test/6/input2_frags.fasta".\n'
+                       'Wrote 4 records to "out_test/4/input2_frags.fasta".\n'
+                       'Done. Processed 1 file.')
+
+        # Same output as chopping each length separately
+        single_dir = os.path.join(out_dir, 'single')
+        for length, overlap in [(6, 3), (4, 0)]:
+            rv, _ = getstatusoutput(f'{RUN} -l {length} -v {overlap}'
+                                    f' -o {single_dir} {TEST2}')
+            assert rv == 0
+            for ext in ['fasta', 'tsv']:
+                name = f'input2_frags.{ext}'
+                multi_file = os.path.join(out_dir, str(length), name)
+                single_file = os.path.join(single_dir, name)
+                assert open(multi_file).read() == open(single_file).read()
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
@@ -6,6 +6,7 @@ from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
+from numpy.typing import ArrayLike
 from pandas.testing import assert_frame_equal
 
 
@@ -69,32 +70,55 @@ def test_make_sorted_df() -> None:
 
 
 # --------------------------------------------------
-def get_coverages(starts: List[int], ends: List[int]) -> List[Tuple[int, int]]:
-    """ Find regions that were aligned """
+def merge_intervals(starts: ArrayLike,
+                    ends: ArrayLike) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge overlapping or touching closed intervals
+
+    Intervals are sorted by start, and a new region begins wherever a
+    start is past the largest end seen so far (cumulative maximum).
+    """
 
-    coverages = [(1, 1)]
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
 
-    # Iterate through all regions with hits
-    for (start, end) in zip(starts, ends):
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
 
-        # Check if current hit region overlaps a previous one
-        overlapping = [
-            cov_start <= start <= cov_end for (cov_start, cov_end) in coverages
-        ]
+    if len(starts) == 0:
+        return starts, ends
 
-        # If there is overlap, merge the regions
-        if any(overlapping):
+    max_ends = np.maximum.accumulate(ends)
+    is_first = np.concatenate(([True], starts[1:] > max_ends[:-1]))
+    is_last = np.concatenate((is_first[1:], [True]))
 
-            # Get index of previous region that has overlap with current
-            i = int(np.where(overlapping)[0])
-            (cov_start, cov_end) = coverages[i]
+    return starts[is_first], max_ends[is_last]
 
-            # Expand coverage region end position
-            coverages[i] = (cov_start, max(end, cov_end))
-        else:
-            # If no overlap, just add the current hit region
-            coverages.append((start, end))
 
+# --------------------------------------------------
+def test_merge_intervals() -> None:
+    """ Test merge_intervals() """
+
+    def merged(starts: List[int], ends: List[int]) -> List[Tuple[int, int]]:
+        merged_starts, merged_ends = merge_intervals(starts, ends)
+        return list(zip(merged_starts.tolist(), merged_ends.tolist()))
+
+    assert merged([], []) == []
+    assert merged([5], [8]) == [(5, 8)]
+    assert merged([1, 3, 20], [10, 5, 30]) == [(1, 10), (20, 30)]
+    assert merged([20, 1, 10], [30, 9, 20]) == [(1, 9), (10, 30)]
+
+
+# --------------------------------------------------
+def get_coverages(starts: ArrayLike,
+                  ends: ArrayLike) -> List[Tuple[int, int]]:
+    """ Find regions that were aligned """
+
+    cov_starts, cov_ends = merge_intervals(starts, ends)
+    coverages = list(zip(cov_starts.tolist(), cov_ends.tolist()))
+
+    # A region of only position 1 is not counted as covered
     if (1, 1) in coverages:
         coverages.remove((1, 1))
 
@@ -136,7 +160,10 @@ def merge_same_adjacent(df: pd.DataFrame) -> pd.DataFrame:
         else:
             if i == 1:
                 out_df = pd.concat([out_df, df.iloc[[0]]])
-            out_df = pd.concat([out_df, df.iloc[[i]]])
+
+            # Start of a run of same hits is added once the run is merged
+            if i == len(df) - 1 or df['hit_id'][i] != df['hit_id'][i + 1]:
+                out_df = pd.concat([out_df, df.iloc[[i]]])
 
     out_df = out_df.reset_index(drop=True)
 
@@ -173,6 +200,18 @@ def test_merge_same_adjacent() -> None:
 
     assert_frame_equal(merge_same_adjacent(in_df), out_df, check_dtype=False)
 
+    # Run of same hits after a different hit
+    in_df = make_sorted_df(
+        [['k1_1', 'GCF_002', 0, 1000, 100, 1, 100, 'chimera'],
+         ['k1_1', 'GCF_001', 0, 1000, 100, 201, 300, 'chimera'],
+         ['k1_1', 'GCF_001', 0, 1000, 100, 401, 500, 'chimera']])
+
+    out_df = make_sorted_df(
+        [['k1_1', 'GCF_002', 0, 1000, 100, 1, 100, 'chimera'],
+         ['k1_1', 'GCF_001', 0, 1000, 300, 201, 500, 'chimera']])
+
+    assert_frame_equal(merge_same_adjacent(in_df), out_df, check_dtype=False)
+
 
 # --------------------------------------------------
 def assign_tax(df: pd.DataFrame) -> pd.DataFrame:
@@ -184,7 +223,7 @@ def assign_tax(df: pd.DataFrame) -> pd.DataFrame:
         return df
 
     # Sort by e_val, check for full length hit, return first one
-    df = df.sort_values(by='e_val', ascending=True)
+    df = df.sort_values(by='e_val', ascending=True, kind='stable')
     for _, hit in df.iterrows():
         if hit['query_length'] == hit['alignment_length']:
             hit['origin'] = 'single'
@@ -356,4 +395,175 @@ def test_separate_and_chimera() -> None:
          ['k1_1', 'GCF_002', 0, 1000, 100, 701, 800, 'chimera'],
          ['k1_1', 'GCF_001', 0, 1000, 100, 901, 1000, 'chimera']])
 
-    assert_frame_equal(assign_tax(in_df), out_df, check_dtype=False)
\ No newline at end of file
+    assert_frame_equal(assign_tax(in_df), out_df, check_dtype=False)
+
+
+# --------------------------------------------------
+def first_in_groups(groups: np.ndarray, *keys: np.ndarray) -> np.ndarray:
+    """ Get position of first element of each group, ordered by keys """
+
+    order = np.lexsort((*reversed(keys), groups))
+    sorted_groups = groups[order]
+
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+
+    return order[is_first]
+
+
+# --------------------------------------------------
+def test_first_in_groups() -> None:
+    """ Test first_in_groups() """
+
+    groups = np.array([1, 0, 1, 0, 2])
+    keys = np.array([5, 3, 2, 3, 1])
+    rows = np.arange(5)
+
+    assert first_in_groups(groups, keys, rows).tolist() == [1, 2, 4]
+    assert first_in_groups(groups, -keys, rows).tolist() == [1, 0, 4]
+    assert first_in_groups(groups[:0], keys[:0]).tolist() == []
+
+
+# --------------------------------------------------
+def assign_tax_all(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Assign taxonomy for all contigs at once
+
+    Same rules as assign_tax(), applied in whole table passes over
+    arrays sorted by contig. Hits tied on e-value (and alignment length)
+    are taken in input order, and contigs are in sorted order.
+    """
+
+    df = df.reset_index(drop=True)
+
+    query_nums, queries = pd.factorize(df['query_id'], sort=True)
+    hit_nums, _ = pd.factorize(df['hit_id'])
+    e_vals = df['e_val'].to_numpy()
+    query_lens = df['query_length'].to_numpy()
+    align_lens = df['alignment_length'].to_numpy()
+    starts = df['start'].to_numpy().astype(np.int64)
+    ends = df['end'].to_numpy().astype(np.int64)
+    rows = np.arange(len(df))
+    n_queries = len(queries)
+
+    # Selected rows, their order within contig, and origin
+    picks: List[np.ndarray] = []
+    positions: List[np.ndarray] = []
+    chimeric: List[np.ndarray] = []
+
+    def pick(chosen: np.ndarray) -> None:
+        picks.append(chosen)
+        positions.append(np.zeros(len(chosen), dtype=np.int64))
+        chimeric.append(np.zeros(len(chosen), dtype=bool))
+        done[query_nums[chosen]] = True
+
+    done = np.zeros(n_queries, dtype=bool)
+    pick(rows[(query_nums >= 0) & (np.bincount(
+        query_nums[query_nums >= 0], minlength=n_queries)[query_nums] == 1)])
+
+    # Full length hit, then hit longer than query, lowest e-value first
+    for is_hit in [query_lens == align_lens, query_lens < align_lens]:
+        hits = rows[(query_nums >= 0) & ~done[query_nums] & is_hit]
+        pick(hits[first_in_groups(query_nums[hits], e_vals[hits], hits)])
+
+    # Hit regions of remaining contigs, kept apart by an offset per contig
+    rest = rows[(query_nums >= 0) & ~done[query_nums]]
+    offset = int(ends.max(initial=0)) + 2
+    offsets = query_nums[rest].astype(np.int64) * offset
+    region_starts, region_ends = merge_intervals(starts[rest] + offsets,
+                                                 ends[rest] + offsets)
+    regions = np.searchsorted(region_starts, starts[rest] + offsets,
+                              side='right') - 1
+
+    # A region of only position 1 is not counted
+    region_queries = region_starts // offset
+    is_counted = ~((region_starts - region_queries * offset == 1) &
+                   (region_ends - region_queries * offset == 1))
+    n_regions = np.bincount(region_queries[is_counted], minlength=n_queries)
+
+    # All hits overlapping, choose lowest e-value then longest alignment
+    hits = rest[n_regions[query_nums[rest]] == 1]
+    pick(hits[first_in_groups(query_nums[hits], e_vals[hits],
+                              -align_lens[hits], hits)])
+
+    # Otherwise choose the same for each region, making a chimera
+    is_chimera = (n_regions[query_nums[rest]] > 1) & is_counted[regions]
+    hits = rest[is_chimera]
+    best = hits[first_in_groups(regions[is_chimera], e_vals[hits],
+                                -align_lens[hits], hits)]
+
+    # Merge adjacent regions aligning to the same genome
+    is_new_run = np.ones(len(best), dtype=bool)
+    is_new_run[1:] = ((query_nums[best][1:] != query_nums[best][:-1]) |
+                      (hit_nums[best][1:] != hit_nums[best][:-1]))
+    is_run_end = np.ones(len(best), dtype=bool)
+    is_run_end[:-1] = is_new_run[1:]
+    run_firsts = np.flatnonzero(is_new_run)
+    run_lasts = np.flatnonzero(is_run_end)
+
+    merged = df.iloc[best[run_lasts]].copy()
+    is_merged = run_lasts > run_firsts
+    if len(best) > 0:
+        merged_starts = starts[best[run_firsts]]
+        merged_ends = ends[best[run_lasts]]
+        merged_e_vals = np.maximum.reduceat(e_vals[best], run_firsts)
+        for col, values in [('e_val', merged_e_vals),
+                            ('alignment_length',
+                             merged_ends - merged_starts + 1),
+                            ('start', merged_starts), ('end', merged_ends)]:
+            merged.loc[is_merged, col] = values[is_merged]
+
+    run_queries = query_nums[best[run_lasts]]
+    n_runs = np.bincount(run_queries, minlength=n_queries)
+
+    # Order of runs within each contig
+    run_positions = np.arange(len(run_firsts)) - np.searchsorted(
+        run_queries, run_queries)
+
+    out_df = pd.concat([df.iloc[np.concatenate(picks)], merged])
+    out_df['origin'] = np.where(
+        np.concatenate([*chimeric, n_runs[run_queries] > 1]), 'chimera',
+        'single')
+
+    order = np.lexsort((np.concatenate([*positions, run_positions]),
+                       query_nums[np.concatenate([*picks, best[run_lasts]])]))
+
+    return out_df.iloc[order].reset_index(drop=True)
+
+
+# --------------------------------------------------
+def test_assign_tax_all() -> None:
+    """ Test assign_tax_all() gives same results as assign_tax() """
+
+    in_df = pd.concat([
+        make_raw_df([['k1_2', 'GCF_001', 0, 535, 535, 1, 535],
+                     ['k1_2', 'GCF_002', 0, 535, 535, 1, 535]]),
+        make_raw_df([['k1_1', 'GCF_001', 0, 570, 417, 1, 416],
+                     ['k1_1', 'GCF_002', 0, 570, 571, 1, 570]]),
+        make_raw_df([['k1_3', 'GCF_001', 0, 1000, 200, 1, 199],
+                     ['k1_3', 'GCF_001', 0, 1000, 200, 3, 201],
+                     ['k1_3', 'GCF_001', 0, 1000, 200, 301, 500],
+                     ['k1_3', 'GCF_001', 0.05, 1000, 250, 251, 500],
+                     ['k1_3', 'GCF_002', 0, 1000, 100, 701, 800],
+                     ['k1_3', 'GCF_001', 0, 1000, 100, 901, 1000]]),
+        make_raw_df([['k1_0', 'GCF_003', 0, 535, 535, 1, 535]]),
+        make_raw_df([['k1_4', 'GCF_001', 0, 500, 200, 1, 199],
+                     ['k1_4', 'GCF_001', 0, 500, 200, 3, 201],
+                     ['k1_4', 'GCF_001', 0, 500, 200, 301, 500],
+                     ['k1_4', 'GCF_001', 0.05, 500, 250, 251, 500]]),
+        make_raw_df([['k1_5', 'GCF_001', 0, 570, 417, 1, 416],
+                     ['k1_5', 'GCF_002', 0, 570, 405, 1, 404],
+                     ['k1_5', 'GCF_003', 0.05, 570, 500, 1, 499]])
+    ])
+
+    out_df = pd.concat(
+        [assign_tax(hits) for _, hits in in_df.groupby('query_id')])
+
+    assert_frame_equal(assign_tax_all(in_df),
+                       out_df.reset_index(drop=True),
+                       check_dtype=False)
+
+    assert_frame_equal(assign_tax_all(in_df.head(0)),
+                       make_sorted_df([]),
+                       check_dtype=False,
+                       check_index_type=False)
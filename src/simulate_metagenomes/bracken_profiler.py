@@ -6,26 +6,45 @@ Purpose: Create profile from Bracken output
 """
 
 import argparse
+import glob
+import multiprocessing as mp
 import os
+import sys
 import pandas as pd
 from pandas.testing import assert_frame_equal
-from typing import List, NamedTuple, TextIO, Tuple
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 
 from phage_injector import rescale_abundances
-from phage_injector import get_phage_content, supplement_phage
+from phage_injector import get_phage_content, make_phage_index
+from phage_injector import PhageIndex, supplement_phage
+from taxonomy import load_taxonomy
 
 pd.options.mode.chained_assignment = None
 
 
 class Args(NamedTuple):
     """ Command-line arguments """
-    profiles: List[TextIO]
-    taxonomy: TextIO
+    profiles: List[str]
+    taxonomy: str
     outdir: str
+    threads: int
     phage: float
     num_phage: int
 
 
+class Shared(NamedTuple):
+    """ Inputs shared by all profiles """
+    taxonomy: pd.DataFrame
+    phage_index: PhageIndex
+    outdir: str
+    phage: float
+    num_phage: int
+
+
+# Shared inputs of pool workers, inherited when they are forked
+WORKER_SHARED: Optional[Shared] = None
+
+
 # ---------------------------------------------------------------------------
 def get_args() -> Args:
     """ Get command-line arguments """
@@ -41,7 +60,13 @@ def get_args() -> Args:
                         metavar='FILE',
                         help='Bracken output file(s)',
                         type=argparse.FileType('rt'),
-                        nargs='+')
+                        nargs='*')
+
+    inputs.add_argument('-d',
+                        '--bracken_dir',
+                        metavar='DIR',
+                        help='Directory of Bracken output files (*.txt)',
+                        type=str)
 
     inputs.add_argument('-t',
                         '--taxonomy',
@@ -57,6 +82,13 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    inputs.add_argument('-n',
+                        '--threads',
+                        metavar='INT',
+                        help='Number of profiles made at a time',
+                        type=int,
+                        default=1)
+
     params.add_argument('-p',
                         '--phage',
                         metavar='PCT',
@@ -73,12 +105,30 @@ def get_args() -> Args:
 
     args = parser.parse_args()
 
+    profiles = [fh.name for fh in args.profiles]
+    for fh in args.profiles:
+        fh.close()
+
+    if args.bracken_dir:
+        if not os.path.isdir(args.bracken_dir):
+            parser.error(f'Directory "{args.bracken_dir}" does not exist')
+        profiles += sorted(glob.glob(os.path.join(args.bracken_dir, '*.txt')))
+
+    if not profiles:
+        parser.error('No Bracken output files given')
+
+    if args.threads <= 0:
+        parser.error(f'Number of threads ({args.threads})'
+                     f' must be greater than 0')
+
     # Convert percent to decimal
     if args.phage >= 1:
         args.phage = args.phage / 100
 
-    return Args(args.profiles, args.taxonomy, args.outdir, args.phage,
-                args.num_phage)
+    args.taxonomy.close()
+
+    return Args(profiles, args.taxonomy.name, args.outdir, args.threads,
+                args.phage, args.num_phage)
 
 
 # ---------------------------------------------------------------------------
@@ -91,36 +141,90 @@ def main() -> None:
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    taxonomy_df = clean_taxonomy(pd.read_csv(args.taxonomy))
+    taxonomy_df = clean_taxonomy(load_taxonomy(args.taxonomy).by_taxid)
 
-    for profile in args.profiles:
+    shared = Shared(taxonomy_df, make_phage_index(taxonomy_df), out_dir,
+                    args.phage, args.num_phage)
 
-        print(f'Making profile for file "{profile.name}"...')
+    for profile, error in zip(
+            args.profiles, make_profiles(args.profiles, shared,
+                                         args.threads)):
 
-        bracken_df = clean_bracken(pd.read_csv(profile, sep='\t'))
+        print(f'Making profile for file "{profile}"...')
 
-        joined_df = join_dfs(bracken_df, taxonomy_df)
+        if error:
+            sys.exit(error)
 
-        joined_df['rescaled_abundance'] = rescale_abundances(
-            joined_df['fraction_total_reads'])
+        print('Finished.')
 
-        if get_phage_content(joined_df) < args.phage:
-            joined_df = supplement_phage(joined_df, taxonomy_df, args.phage,
-                                         args.num_phage)
+    n_profiles = len(args.profiles)
+    plu = 's' if n_profiles != 1 else ''
+    print(f'Done. Wrote {n_profiles} profile{plu} to {out_dir}.')
 
-        files_df = make_files_df(joined_df)
-        profile_df = make_profile_df(joined_df)
 
-        files_output, profile_output = make_filenames(out_dir, profile.name)
+# ---------------------------------------------------------------------------
+def make_profiles(profiles: List[str], shared: Shared,
+                  threads: int) -> Iterator[Optional[str]]:
+    """ Make each profile, yielding error messages in order """
 
-        files_df.to_csv(files_output, sep=",", index=False)
-        profile_df.to_csv(profile_output, sep="\t", index=False, header=False)
+    # No pool is started for a single profile or thread
+    if threads == 1 or len(profiles) < 2:
+        for profile in profiles:
+            yield make_profile(profile, shared)
+        return
 
-        print('Finished.')
+    # Workers are given shared inputs once, rather than with each profile
+    with mp.Pool(min(threads, len(profiles)),
+                 initializer=set_worker_shared,
+                 initargs=(shared, )) as pool:
+        yield from pool.imap(make_worker_profile, profiles)
 
-    n_profiles = len(args.profiles)
-    plu = 's' if n_profiles != 1 else ''
-    print(f'Done. Wrote {n_profiles} profile{plu} to {out_dir}.')
+
+# ---------------------------------------------------------------------------
+def set_worker_shared(shared: Shared) -> None:
+    """ Keep shared inputs in pool worker """
+
+    global WORKER_SHARED  # pylint: disable=global-statement
+    WORKER_SHARED = shared
+
+
+# ---------------------------------------------------------------------------
+def make_worker_profile(profile: str) -> Optional[str]:
+    """ Make profile in pool worker """
+
+    assert WORKER_SHARED is not None
+
+    return make_profile(profile, WORKER_SHARED)
+
+
+# ---------------------------------------------------------------------------
+def make_profile(profile: str, shared: Shared) -> Optional[str]:
+    """ Make profile from Bracken output, returning any error message """
+
+    bracken_df = clean_bracken(pd.read_csv(profile, sep='\t'))
+
+    joined_df = join_dfs(bracken_df, shared.taxonomy)
+
+    joined_df['rescaled_abundance'] = rescale_abundances(
+        joined_df['fraction_total_reads'])
+
+    if get_phage_content(joined_df) < shared.phage:
+        try:
+            joined_df = supplement_phage(joined_df, shared.taxonomy,
+                                         shared.phage, shared.num_phage,
+                                         shared.phage_index)
+        except SystemExit as err:
+            return str(err)
+
+    files_df = make_files_df(joined_df)
+    profile_df = make_profile_df(joined_df)
+
+    files_output, profile_output = make_filenames(shared.outdir, profile)
+
+    files_df.to_csv(files_output, sep=",", index=False)
+    profile_df.to_csv(profile_output, sep="\t", index=False, header=False)
+
+    return None
 
 
 # ---------------------------------------------------------------------------
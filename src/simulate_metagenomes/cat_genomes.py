@@ -6,11 +6,25 @@ Purpose: Concatenate genomes from profile into single multifasta
 """
 
 import argparse
+import bisect
 from glob import glob
+import gzip
+import hashlib
+import json
 import os
 import pandas as pd
+import shutil
 import sys
-from typing import List, NamedTuple, TextIO
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, TextIO
+
+from shared_files import get_umask, make_temp_file
+
+# Genomes are copied a block at a time
+BLOCK_SIZE = 1024**2
+
+# Index of genome files, kept in --parent
+INDEX_NAME = '.genome_index.json'
+INDEX_VERSION = 1
 
 
 class Args(NamedTuple):
@@ -18,6 +32,20 @@ class Args(NamedTuple):
     glob_files: List[TextIO]
     parent: str
     outdir: str
+    cache: Optional[str]
+    cache_size: float
+
+
+class GenomeCache(NamedTuple):
+    """ Directory of concatenated genomes, and its maximum size in bytes """
+    path: str
+    max_size: int
+
+
+class GenomeIndex(NamedTuple):
+    """ Sorted file names in each directory of parent """
+    parent: str
+    files: Dict[str, List[str]]
 
 
 # --------------------------------------------------
@@ -48,6 +76,19 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-c',
+                        '--cache',
+                        help='Directory of genomes cached between runs',
+                        metavar='DIR',
+                        type=str)
+
+    parser.add_argument('-s',
+                        '--cache_size',
+                        help='Maximum size of genome cache in GB',
+                        metavar='GB',
+                        type=float,
+                        default=100.)
+
     args = parser.parse_args()
 
     if not os.path.isdir(args.parent):
@@ -56,7 +97,12 @@ def get_args() -> Args:
     if len(os.listdir(args.parent)) == 0:
         parser.error(f'--parent "{args.parent}" is empty')
 
-    return Args(args.glob_files, args.parent, args.outdir)
+    if args.cache_size <= 0:
+        parser.error(f'--cache_size ({args.cache_size}) must be greater'
+                     ' than 0')
+
+    return Args(args.glob_files, args.parent, args.outdir, args.cache,
+                args.cache_size)
 
 
 # --------------------------------------------------
@@ -70,21 +116,39 @@ def main() -> None:
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
+    index = load_genome_index(parent)
+
+    cache = None
+    if args.cache:
+        cache = GenomeCache(args.cache, int(args.cache_size * 1e9))
+        make_cache_dirs(cache)
+
     for in_fh in args.glob_files:
 
-        out_fh = open(make_filename(out_dir, in_fh.name), 'wt')
+        out_fh = open(make_filename(out_dir, in_fh.name), 'wb')
 
-        genomes = get_matches(parent, parse_globfile(in_fh))
+        genomes = get_matches(index, parse_globfile(in_fh))
 
         n_files = 0
-        for _, row in genomes.iterrows():
+        n_cached = 0
+        for filename, accession in zip(genomes['filename'],
+                                       genomes['accession']):
             n_files += 1
-            cat_genome(row.filename, row.accession, out_fh)
+            if cache:
+                n_cached += cat_cached_genome(cache, filename, accession,
+                                              out_fh)
+            else:
+                cat_genome(filename, accession, out_fh)
 
         out_fh.close()
 
         plu = 's' if n_files != 1 else ''
-        print(f'Concatenated {n_files} file{plu} to {out_fh.name}')
+        from_cache = f' ({n_cached} from cache)' if cache else ''
+        print(f'Concatenated {n_files} file{plu} to {out_fh.name}'
+              f'{from_cache}')
+
+        if cache:
+            prune_cache(cache)
 
     n_profiles = len(args.glob_files)
     plu = 's' if n_profiles != 1 else ''
@@ -126,21 +190,179 @@ def parse_globfile(fh: TextIO) -> pd.DataFrame:
 
 
 # --------------------------------------------------
-def get_matches(parent: str, df: pd.DataFrame) -> pd.DataFrame:
+def get_dir_mtimes(parent: str) -> Dict[str, int]:
+    """ Get modification time of each directory in parent """
+
+    return {
+        entry.name: entry.stat().st_mtime_ns
+        for entry in os.scandir(parent) if entry.is_dir()
+    }
+
+
+# --------------------------------------------------
+def scan_genomes(parent: str) -> GenomeIndex:
+    """ List files in each directory of parent """
+
+    files = {
+        entry.name: sorted(os.listdir(entry.path))
+        for entry in os.scandir(parent) if entry.is_dir()
+    }
+
+    return GenomeIndex(parent, files)
+
+
+# --------------------------------------------------
+def load_genome_index(parent: str) -> GenomeIndex:
+    """ Read index of genome files, or make it if directories changed """
+
+    index_file = os.path.join(parent, INDEX_NAME)
+    mtimes = get_dir_mtimes(parent)
+
+    try:
+        with open(index_file, 'rt') as fh:
+            saved = json.load(fh)
+        if saved['version'] == INDEX_VERSION and saved['mtimes'] == mtimes:
+            return GenomeIndex(parent, saved['files'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    index = scan_genomes(parent)
+
+    # Written under another name first, so readers see a whole file
+    try:
+        fd, tmp_name = make_temp_file(parent, INDEX_NAME)
+    except OSError:
+        return index
+
+    try:
+        with os.fdopen(fd, 'wt') as fh:
+            json.dump(
+                {
+                    'version': INDEX_VERSION,
+                    'mtimes': mtimes,
+                    'files': index.files
+                }, fh)
+        os.replace(tmp_name, index_file)
+    except OSError:
+        os.remove(tmp_name)
+
+    return index
+
+
+# --------------------------------------------------
+def test_load_genome_index(tmp_path) -> None:
+    """ Test load_genome_index() """
+
+    parent = str(tmp_path)
+    os.makedirs(os.path.join(parent, 'viral'))
+    os.makedirs(os.path.join(parent, 'archaea'))
+    for name in ['viral/GCF_2_b_genomic.fna', 'viral/GCF_1_a_genomic.fna']:
+        open(os.path.join(parent, name), 'wt').close()
+
+    index = load_genome_index(parent)
+
+    assert index.files == {
+        'archaea': [],
+        'viral': ['GCF_1_a_genomic.fna', 'GCF_2_b_genomic.fna']
+    }
+    assert os.path.isfile(os.path.join(parent, INDEX_NAME))
+
+    # Index can be read by other users, as allowed by the umask
+    assert os.stat(os.path.join(parent, INDEX_NAME)).st_mode & 0o777 == \
+        0o666 & ~get_umask()
+
+    # Saved index is used while directories are unchanged
+    with open(os.path.join(parent, INDEX_NAME), 'rt') as fh:
+        saved = json.load(fh)
+    saved['files']['viral'] = ['GCF_3_c_genomic.fna']
+    with open(os.path.join(parent, INDEX_NAME), 'wt') as fh:
+        json.dump(saved, fh)
+
+    assert load_genome_index(parent).files['viral'] == ['GCF_3_c_genomic.fna']
+
+    # Index is made again when a directory changes
+    open(os.path.join(parent, 'archaea', 'GCF_4_d_genomic.fna'), 'wt').close()
+    os.utime(os.path.join(parent, 'archaea'), ns=(1, 1))
+
+    assert load_genome_index(parent).files == {
+        'archaea': ['GCF_4_d_genomic.fna'],
+        'viral': ['GCF_1_a_genomic.fna', 'GCF_2_b_genomic.fna']
+    }
+
+
+# --------------------------------------------------
+def find_genomes(index: GenomeIndex, file_glob: str) -> List[str]:
+    """ Get files matching glob relative to parent, like DIR/PREFIX*.fna """
+
+    dir_name, file_name = os.path.split(file_glob)
+    prefix, star, suffix = file_name.partition('*')
+
+    # Other globs are matched against the file system
+    names = index.files.get(dir_name)
+    if names is None or not star or any(char in prefix + suffix
+                                        for char in '*?['):
+        return sorted(glob(os.path.join(index.parent, file_glob)))
+
+    matches = []
+    for name in names[bisect.bisect_left(names, prefix):]:
+        if not name.startswith(prefix):
+            break
+        # As with glob, hidden files must be matched explicitly
+        if name.startswith('.') and not prefix:
+            continue
+        if name.endswith(suffix) and len(name) >= len(prefix + suffix):
+            matches.append(os.path.join(index.parent, dir_name, name))
+
+    return matches
+
+
+# --------------------------------------------------
+def test_find_genomes() -> None:
+    """ Test find_genomes() """
+
+    index = GenomeIndex(
+        'refseq', {
+            'viral': [
+                'GCF_1.1_a_genomic.fna', 'GCF_1.1_a_genomic.fna.gz',
+                'GCF_1.12_b_genomic.fna', 'GCF_2.1_c_genomic.fna'
+            ]
+        })
+
+    assert find_genomes(index, 'viral/GCF_2.1*.fna') == [
+        'refseq/viral/GCF_2.1_c_genomic.fna'
+    ]
+    assert find_genomes(index, 'viral/GCF_1.1*.fna') == [
+        'refseq/viral/GCF_1.1_a_genomic.fna',
+        'refseq/viral/GCF_1.12_b_genomic.fna'
+    ]
+    assert find_genomes(index, 'viral/GCF_1.1*.fna.gz') == [
+        'refseq/viral/GCF_1.1_a_genomic.fna.gz'
+    ]
+    assert find_genomes(index, 'viral/GCF_3.1*.fna') == []
+    assert find_genomes(index, 'viral/GCF_2.1_c_genomic.fna*') == [
+        'refseq/viral/GCF_2.1_c_genomic.fna'
+    ]
+
+
+# --------------------------------------------------
+def get_matches(index: GenomeIndex, df: pd.DataFrame) -> pd.DataFrame:
     """ Get filenames that match the globs """
 
+    parent = index.parent
+
     df['glob'] = list(
         map(lambda s: os.path.join(parent, s), df['partial_glob']))
 
     df = df.reset_index()
 
     missing = False
+    filenames: List[Optional[str]] = []
 
-    for index, row in df.iterrows():
-        file_glob = row['glob']
-        file_match = glob(file_glob)
+    for partial_glob, file_glob in zip(df['partial_glob'], df['glob']):
+        file_match = find_genomes(index, partial_glob) or find_genomes(
+            index, partial_glob + '.gz')
         if file_match:
-            df.at[index, 'filename'] = file_match[0]
+            filenames.append(file_match[0])
             if len(file_match) > 1:
                 print(f'Warning: multiple files match "{file_glob}":')
                 print('\t', end='')
@@ -149,26 +371,315 @@ def get_matches(parent: str, df: pd.DataFrame) -> pd.DataFrame:
         else:
             # This will fail, but continue to see which globs do not match
             missing = True
+            filenames.append(None)
             print(f'No files match glob "{file_glob}"')
 
     if missing:
         sys.exit('Error: Will not create incomplete profile.\n'
                  f'Check --parent "{parent}".')
 
+    df['filename'] = filenames
+
     return df
 
 
 # --------------------------------------------------
-def cat_genome(file_name: str, accession: str, out_fh: TextIO) -> None:
+def open_genome(file_name: str) -> BinaryIO:
+    """ Open genome file, which may be gzipped """
+
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')  # type: ignore
+
+    return open(file_name, 'rb')
+
+
+# --------------------------------------------------
+def strip_headers(lines: bytes) -> bytes:
+    """ Remove lines with '>' from complete lines """
+
+    return b''.join(line + b'\n' for line in lines.split(b'\n')[:-1]
+                    if b'>' not in line)
+
+
+# --------------------------------------------------
+def test_strip_headers() -> None:
+    """ Test strip_headers() """
+
+    assert strip_headers(b'>NC_1 phage\nACGT\nAC\n') == b'ACGT\nAC\n'
+    assert strip_headers(b'ACGT\n\n>NC_2\nTT\n') == b'ACGT\n\nTT\n'
+    assert strip_headers(b'ACGT\n') == b'ACGT\n'
+
+
+# --------------------------------------------------
+def cat_genome(file_name: str,
+               accession: str,
+               out_fh: BinaryIO,
+               block_size: int = BLOCK_SIZE) -> None:
     """ Concatenate genome file to output file """
 
-    contents = open(file_name, 'rt').read()
+    out_fh.write(f'>{accession}\n'.encode())
+
+    # Lines are only split in blocks containing headers
+    line = bytearray()
+    with open_genome(file_name) as in_fh:
+        for block in iter(lambda: in_fh.read(block_size), b''):
+            end = block.rfind(b'\n') + 1
+            if not end:
+                line += block
+                continue
+
+            lines = bytes(line) + block[:end] if line else block[:end]
+            line = bytearray(block[end:])
+
+            out_fh.write(strip_headers(lines) if b'>' in lines else lines)
+
+    # Text after the last newline is always ended with one
+    if b'>' not in line:
+        out_fh.write(bytes(line) + b'\n')
+
+
+# --------------------------------------------------
+def test_cat_genome(tmp_path) -> None:
+    """ Test cat_genome() """
+
+    genome = ('>NC_1 phage, segment 1\nACGTACGT\nACG\n'
+              '>NC_2 phage, segment 2\nTTTTTTTTTTTT\nGG\n')
+    expected = '>GCF_1\nACGTACGT\nACG\nTTTTTTTTTTTT\nGG\n\n'
+
+    fna = tmp_path / 'GCF_1_genomic.fna'
+    fna.write_text(genome)
+
+    with gzip.open(str(fna) + '.gz', 'wt') as fh:
+        fh.write(genome)
+
+    # Blocks may end anywhere, including in headers and long lines
+    for file_name in [str(fna), str(fna) + '.gz']:
+        for block_size in [1, 5, 16, BLOCK_SIZE]:
+            out_file = tmp_path / 'genomes.fasta'
+            with open(out_file, 'wb') as out_fh:
+                cat_genome(file_name, 'GCF_1', out_fh, block_size)
+
+            assert out_file.read_text() == expected
+
+    # No newline at end of file
+    fna.write_text(genome.rstrip('\n'))
+    with open(tmp_path / 'genomes.fasta', 'wb') as out_fh:
+        cat_genome(str(fna), 'GCF_1', out_fh, 4)
+
+    assert (tmp_path / 'genomes.fasta').read_text() == expected[:-1]
+
+
+# --------------------------------------------------
+def make_cache_dirs(cache: GenomeCache) -> None:
+    """ Create directories of genome cache """
+
+    for name in ['keys', 'genomes']:
+        os.makedirs(os.path.join(cache.path, name), exist_ok=True)
+
+
+# --------------------------------------------------
+def get_source_key(file_name: str, accession: str) -> str:
+    """ Identify genome file by its path, size, and modification time """
+
+    stat = os.stat(file_name)
+    source = '\0'.join([
+        accession,
+        os.path.realpath(file_name),
+        str(stat.st_size),
+        str(stat.st_mtime_ns)
+    ])
+
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+# --------------------------------------------------
+def copy_genome(file_name: str, out_fh: BinaryIO) -> str:
+    """ Copy concatenated genome to output, returning its digest """
+
+    digest = hashlib.sha256()
+
+    with open(file_name, 'rb') as in_fh:
+        for block in iter(lambda: in_fh.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            out_fh.write(block)
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def write_atomic(cache: GenomeCache, path: str, text: str) -> None:
+    """ Write small file in cache under another name, then rename it """
+
+    fd, tmp_name = make_temp_file(cache.path, '.tmp')
+
+    with os.fdopen(fd, 'wt') as fh:
+        fh.write(text)
+
+    os.replace(tmp_name, path)
+
+
+# --------------------------------------------------
+def cat_cached_genome(cache: GenomeCache, file_name: str, accession: str,
+                      out_fh: BinaryIO) -> bool:
+    """ Concatenate genome through cache, returning whether it was cached """
+
+    key_file = os.path.join(cache.path, 'keys', get_source_key(
+        file_name, accession))
+
+    # Genomes are stored by digest of their contents, so identical genomes
+    # from different files are only kept once
+    try:
+        with open(key_file, 'rt') as fh:
+            genome_file = os.path.join(cache.path, 'genomes',
+                                       fh.read().strip() + '.fasta')
+        in_fh = open(genome_file, 'rb')
+
+    # Missing, or made by another user and not readable
+    except OSError:
+        in_fh = None
+
+    # Once open, the genome can be read even if another run removes it
+    if in_fh is not None:
+        with in_fh:
+            # Modification time marks when the genome was last used
+            os.utime(in_fh.fileno())
+            shutil.copyfileobj(in_fh, out_fh, BLOCK_SIZE)
+        return True
+
+    fd, tmp_name = make_temp_file(cache.path, '.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as tmp_fh:
+            cat_genome(file_name, accession, tmp_fh)
+
+        digest = copy_genome(tmp_name, out_fh)
+        os.replace(tmp_name,
+                   os.path.join(cache.path, 'genomes', digest + '.fasta'))
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+    write_atomic(cache, key_file, digest)
+
+    return False
+
+
+# --------------------------------------------------
+def prune_cache(cache: GenomeCache) -> None:
+    """ Remove least recently used genomes until cache fits """
+
+    genomes = []
+    for entry in os.scandir(os.path.join(cache.path, 'genomes')):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        genomes.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in genomes)
+
+    for _, size, path in sorted(genomes):
+        if total <= cache.max_size:
+            break
+
+        # Another run may have removed it already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    # Keys of removed genomes are left, and are misses when next used
+
+
+# --------------------------------------------------
+def test_cat_cached_genome(tmp_path, monkeypatch) -> None:
+    """ Test cat_cached_genome() """
+
+    fna_1 = tmp_path / 'GCF_1_genomic.fna'
+    fna_1.write_text('>NC_1 phage\nACGT\n')
+    fna_2 = tmp_path / 'GCF_2_genomic.fna'
+    fna_2.write_text('>NC_2 phage\nTTTT\n')
+
+    cache = GenomeCache(str(tmp_path / 'cache'), 1000)
+    make_cache_dirs(cache)
+
+    def cat_all() -> List[bool]:
+        with open(tmp_path / 'genomes.fasta', 'wb') as out_fh:
+            return [
+                cat_cached_genome(cache, str(fna), accession, out_fh)
+                for fna, accession in [(fna_1, 'GCF_1'), (fna_2, 'GCF_2'),
+                                       (fna_1, 'GCF_1')]
+            ]
+
+    expected = '>GCF_1\nACGT\n\n>GCF_2\nTTTT\n\n>GCF_1\nACGT\n\n'
+
+    # Same output, whether cached or not
+    assert cat_all() == [False, False, True]
+    assert (tmp_path / 'genomes.fasta').read_text() == expected
+    assert cat_all() == [True, True, True]
+    assert (tmp_path / 'genomes.fasta').read_text() == expected
+
+    genomes_dir = tmp_path / 'cache' / 'genomes'
+    assert len(os.listdir(genomes_dir)) == 2
+
+    # Changed genome file is not taken from cache
+    fna_2.write_text('>NC_2 phage\nGGGG\n')
+    os.utime(fna_2, ns=(1, 1))
+    assert cat_all() == [True, False, True]
+    assert '>GCF_2\nGGGG\n' in (tmp_path / 'genomes.fasta').read_text()
+    assert len(os.listdir(genomes_dir)) == 3
+
+    # Least recently used genome is removed first
+    for i, name in enumerate(sorted(os.listdir(genomes_dir))):
+        os.utime(genomes_dir / name, ns=(i, i))
+    oldest = sorted(os.listdir(genomes_dir))[0]
+
+    prune_cache(GenomeCache(cache.path, 26))
+    assert oldest not in os.listdir(genomes_dir)
+    assert len(os.listdir(genomes_dir)) == 2
+
+    prune_cache(GenomeCache(cache.path, 1))
+    assert not os.listdir(genomes_dir)
+
+    # Output is still made after genomes are removed
+    assert cat_all() == [False, False, True]
+    assert (tmp_path / 'genomes.fasta').read_text() == \
+        expected.replace('TTTT', 'GGGG')
+
+    # Genome removed by another run while being copied is written once
+    def copy_and_prune(in_fh, out_fh, length) -> None:
+        out_fh.write(in_fh.read())
+        prune_cache(GenomeCache(cache.path, 1))
+
+    monkeypatch.setattr(shutil, 'copyfileobj', copy_and_prune)
+
+    with open(tmp_path / 'genomes.fasta', 'wb') as out_fh:
+        assert cat_cached_genome(cache, str(fna_1), 'GCF_1', out_fh)
+
+    assert (tmp_path / 'genomes.fasta').read_text() == '>GCF_1\nACGT\n\n'
+    monkeypatch.undo()
+
+    # Cache can be read by other users, as allowed by the umask
+    mode = 0o666 & ~get_umask()
+    for name in ['keys', 'genomes']:
+        for entry in os.scandir(os.path.join(cache.path, name)):
+            assert entry.stat().st_mode & 0o777 == mode
+
+    # Genomes cached by another user that cannot be read are misses
+    real_open = open
+
+    def open_unreadable(file, mode='r', *args, **kwargs):
+        if str(file).startswith(str(genomes_dir)) and mode == 'rb':
+            raise PermissionError(13, 'Permission denied', str(file))
+        return real_open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr('builtins.open', open_unreadable)
 
-    out_fh.write(f'>{accession}\n')
+    with open(tmp_path / 'genomes.fasta', 'wb') as out_fh:
+        assert not cat_cached_genome(cache, str(fna_1), 'GCF_1', out_fh)
 
-    for line in contents.split('\n'):
-        if ">" not in line:
-            out_fh.write(line + '\n')
+    assert (tmp_path / 'genomes.fasta').read_text() == '>GCF_1\nACGT\n\n'
 
 
 # --------------------------------------------------
@@ -10,6 +10,7 @@ import os
 import pandas as pd
 import re
 import sys
+import table_io
 from typing import List, NamedTuple, TextIO
 
 
@@ -18,6 +19,7 @@ class Args(NamedTuple):
     files: List[TextIO]
     regex: str
     out_dir: str
+    format: str
 
 
 class Nameparts(NamedTuple):
@@ -57,9 +59,19 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.files, args.regex, args.outdir)
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.files, args.regex, args.outdir, args.format)
 
 
 # --------------------------------------------------
@@ -74,9 +86,9 @@ def main() -> None:
 
     out_df = concat_files(args.regex, args.files)
 
-    out_file = os.path.join(out_dir, 'combined.csv')
+    out_file = os.path.join(out_dir, 'combined.' + args.format)
 
-    out_df.to_csv(out_file, index=False)
+    table_io.write_table(out_df, out_file)
 
     print(f'Done. Wrote output to {out_file}')
 
@@ -10,6 +10,7 @@ import os
 import pandas as pd
 import re
 import sys
+import table_io
 from typing import List, NamedTuple, Optional, TextIO, Tuple
 
 
@@ -18,6 +19,7 @@ class Args(NamedTuple):
     files: List[TextIO]
     regex: str
     out_dir: str
+    format: str
 
 
 class Nameparts(NamedTuple):
@@ -57,9 +59,19 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.files, args.regex, args.outdir)
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.files, args.regex, args.outdir, args.format)
 
 
 # --------------------------------------------------
@@ -74,9 +86,9 @@ def main() -> None:
 
     out_df, filename = concat_files(args.regex, args.files)
 
-    out_file = make_filename(out_dir, filename)
+    out_file = make_filename(out_dir, filename, args.format)
 
-    out_df.to_csv(out_file, index=False)
+    table_io.write_table(out_df, out_file)
 
     print(f'Done. Wrote output to {out_file}')
 
@@ -90,7 +102,7 @@ def concat_files(regex: str, files: List[TextIO]) -> Tuple[pd.DataFrame, str]:
     for file in files:
         parts = match_regex(regex, file.name)
 
-        df = pd.read_csv(file)
+        df = table_io.read_table(file)
 
         df['profile'] = parts.profile
 
@@ -159,10 +171,10 @@ def test_match_regex() -> None:
 
 
 # --------------------------------------------------
-def make_filename(out_dir: str, filename: str) -> str:
+def make_filename(out_dir: str, filename: str, fmt: str = 'csv') -> str:
     """ Make output filename """
 
-    out_file = os.path.join(out_dir, 'combined_' + filename + '.csv')
+    out_file = os.path.join(out_dir, f'combined_{filename}.{fmt}')
 
     return out_file
 
@@ -177,6 +189,8 @@ def test_make_filename() -> None:
                          'contig_summary') == 'out/combined_contig_summary.csv'
     assert make_filename(
         'out', 'profile_comparison') == 'out/combined_profile_comparison.csv'
+    assert make_filename('out', 'parsed_blast',
+                         'parquet') == 'out/combined_parsed_blast.parquet'
 
 
 # --------------------------------------------------
@@ -4,14 +4,22 @@ Date   : 2022-03-31
 Purpose: Provide fucntions to increase pahge content of profile
 """
 
+import bisect
 import pandas as pd
 import sys
 from pandas.testing import assert_frame_equal
-from typing import List, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 pd.options.mode.chained_assignment = None
 
 
+class PhageIndex(NamedTuple):
+    """ Phages, with lowercased species names sorted for prefix search """
+    phages: pd.DataFrame
+    species: List[str]
+    positions: List[int]
+
+
 # ---------------------------------------------------------------------------
 def rescale_abundances(col: pd.Series, total: float = 1) -> pd.Series:
     """ Rescale abundances to add to total """
@@ -141,10 +149,79 @@ def anti_join_profiles(df: pd.DataFrame,
     return df
 
 
+# ---------------------------------------------------------------------------
+def index_phages(phages: pd.DataFrame) -> PhageIndex:
+    """ Sort lowercased phage species names, keeping their positions """
+
+    species = phages['species'].str.lower().tolist()
+    pairs = sorted(zip(species, range(len(species))))
+
+    return PhageIndex(phages, [name for name, _ in pairs],
+                      [position for _, position in pairs])
+
+
+# ---------------------------------------------------------------------------
+def add_indexed_phage(index: PhageIndex, species: str, position: int) -> None:
+    """ Add lowercased species name of phage appended at `position` """
+
+    i = bisect.bisect_right(index.species, species)
+
+    index.species.insert(i, species)
+    index.positions.insert(i, position)
+
+
+# ---------------------------------------------------------------------------
+def make_phage_index(tax: pd.DataFrame) -> PhageIndex:
+    """ Index all phages in taxonomy for lookup by host genus """
+
+    return index_phages(get_phages(tax))
+
+
+# ---------------------------------------------------------------------------
+def find_phages(index: PhageIndex, genus: str) -> List[int]:
+    """ Get positions of phages whose species starts with lowercased genus """
+
+    # Names starting with genus sort between it and genus + the last character
+    start = bisect.bisect_left(index.species, genus)
+    end = bisect.bisect_left(index.species, genus + chr(sys.maxunicode),
+                             start)
+
+    return sorted(index.positions[start:end])
+
+
+# ---------------------------------------------------------------------------
+def test_find_phages() -> None:
+    """ Test find_phages() """
+
+    tax = pd.DataFrame(
+        [['bacteria', 'Thermus', 'Thermus thermophilus', 'GCF1', 123],
+         ['viral', '', 'Thermus phage phiYS40', 'GCF5', 852],
+         ['viral', '', 'Salmonella phage g341c', 'GCF7', 147],
+         ['viral', '', 'Thermus phage TMA', 'GCF9', 369],
+         ['viral', '', 'Candidatus Pelagibacter phage', 'GCF6', 963]],
+        columns=['kingdom', 'genus', 'species', 'accession', 'taxid'])
+
+    index = make_phage_index(tax)
+
+    assert list(index.phages['taxid']) == [852, 147, 369, 963]
+    assert find_phages(index, 'thermus') == [0, 2]
+    assert find_phages(index, 'salmonella') == [1]
+    assert find_phages(index, 'escherichia') == []
+    assert find_phages(index, 'therm') == [0, 2]
+    assert find_phages(index, 'candidatus pelagibacter') == [3]
+    assert find_phages(index, 'candidatus liberibacter') == []
+
+    add_indexed_phage(index, 'escherichia phage d108', 4)
+    add_indexed_phage(index, 'thermus phage tma', 5)
+
+    assert find_phages(index, 'escherichia') == [4]
+    assert find_phages(index, 'thermus') == [0, 2, 5]
+
+
 # ---------------------------------------------------------------------------
 def get_phage_from_hosts(phages: pd.DataFrame, nonviral: pd.DataFrame,
                          num_phage: int,
-                         all_phage: pd.DataFrame) -> List[Tuple[str, str]]:
+                         all_phage: PhageIndex) -> pd.DataFrame:
     """
     Retrieve phages corresponging to nonviral hosts
 
@@ -152,10 +229,11 @@ def get_phage_from_hosts(phages: pd.DataFrame, nonviral: pd.DataFrame,
     `phages`: Phages in profile
     `nonviral`: Nonviral portion of profile
     `num_phage`: Minimum number of phages in profile
-    `all_phage`: All phages in local database
+    `all_phage`: All phages in local database, indexed by genus
 
     Return:
-    List of tuples with (host_taxid, phage_taxid)
+    `phages` with phages added for hosts, and columns `host_abundance`
+    and `host_taxid`
     """
 
     phages['host_abundance'] = 0.
@@ -166,62 +244,96 @@ def get_phage_from_hosts(phages: pd.DataFrame, nonviral: pd.DataFrame,
                          inplace=True,
                          ignore_index=True)
 
+    # Phages in profile, including those added below
+    present = index_phages(phages)
+    taxids = phages['taxid'].tolist()
+    added: List[int] = []
+    hosts: Dict[int, Tuple[float, int]] = {}
+
     for organism in nonviral.itertuples():
         genus = str(organism.genus).lower()
 
         # First, check if host's phage is already present in profile
-        matches = phages['species'].str.lower().str.startswith(genus)
-        if any(matches):
-            phage_matches = phages[matches]
-            for _, phage_match in phage_matches.iterrows():
-                phages = add_host_phage(organism, phage_match, phages)
+        matches = find_phages(present, genus)
+        if matches:
+            for position in matches:
+                add_host_phage(organism, taxids[position], hosts)
             continue
 
         # If number of phages already met, do not look for others
         # But keep in the loop to link present phages to hosts
-        if len(phages) >= num_phage:
+        if len(taxids) >= num_phage:
             continue
 
         # Now search for phages matching host in all phages
-        matches = all_phage['species'].str.lower().str.startswith(genus)
-        if any(matches):
-            phage_matches = all_phage[matches]
-            phage_match = phage_matches.iloc[0]
-            phages = add_host_phage(organism, phage_match, phages)
+        matches = find_phages(all_phage, genus)
+        if matches:
+            phage = all_phage.phages.iloc[matches[0]]
+            if phage['taxid'] not in taxids:
+                add_indexed_phage(present,
+                                  str(phage['species']).lower(), len(taxids))
+                taxids.append(phage['taxid'])
+                added.append(matches[0])
+            add_host_phage(organism, phage['taxid'], hosts)
+
+    # New phages and host information are only added once, at the end
+    if added:
+        phages = pd.concat([phages, all_phage.phages.iloc[added]])
+
+    phages['host_abundance'] = [
+        hosts[taxid][0] if taxid in hosts else 0. for taxid in phages['taxid']
+    ]
+    phages['host_taxid'] = [
+        hosts[taxid][1] if taxid in hosts else '' for taxid in phages['taxid']
+    ]
 
     return phages
 
 
 # ---------------------------------------------------------------------------
-def add_host_phage(host: pd.Series, phage: pd.Series, phages: pd.DataFrame):
+def add_host_phage(host: Any, phage_taxid: int,
+                   hosts: Dict[int, Tuple[float, int]]) -> None:
     """
-    Add host info (and phage if not present) to phages df
+    Add host info to phage
 
     Parameters:
     `host`: Nonviral organism whose genus is in phage species name
-    `phage`: Phage whose species includes nonviral organism genus
-    `phages`: Df of phages in profile
-
-    Returns:
-    `phages` dataframe with new host information and possibly new phage.
+    `phage_taxid`: Taxid of phage whose species includes host genus
+    `hosts`: Total host abundance and last host taxid of each phage taxid
     """
 
-    phage_taxid = phage['taxid']
+    host_abundance, _ = hosts.get(phage_taxid, (0., 0))
 
-    if phage_taxid not in phages['taxid'].values:
-        phages = phages.append(phage)
-        phages['host_abundance'][phages['taxid'] == phage_taxid] = 0.
+    hosts[phage_taxid] = (host_abundance + host.abundance, host.taxid)
 
-    phages['host_abundance'][phages['taxid'] == phage_taxid] += host.abundance
-    phages['host_taxid'][phages['taxid'] == phage_taxid] = host.taxid
 
-    return phages
+# ---------------------------------------------------------------------------
+def test_add_host_phage() -> None:
+    """ Test add_host_phage() """
+
+    host = pd.DataFrame([[0.3, 456], [0.2, 789]],
+                        columns=['abundance', 'taxid'])
+    hosts: Dict[int, Tuple[float, int]] = {}
+
+    for organism in host.itertuples():
+        add_host_phage(organism, 147, hosts)
+    add_host_phage(next(host.itertuples()), 258, hosts)
+
+    assert hosts == {147: (0.5, 789), 258: (0.3, 456)}
 
 
 # ---------------------------------------------------------------------------
-def supplement_phage(profile: pd.DataFrame, tax: pd.DataFrame,
-                     phage_content: float, num_phage: int) -> pd.DataFrame:
-    """ Add more phage to profile """
+def supplement_phage(
+        profile: pd.DataFrame,
+        tax: pd.DataFrame,
+        phage_content: float,
+        num_phage: int,
+        phage_index: Optional[PhageIndex] = None) -> pd.DataFrame:
+    """
+    Add more phage to profile
+
+    Phages in `tax` are indexed by genus unless `phage_index` is given
+    """
 
     profile = profile.rename(columns={'rescaled_abundance': 'abundance'})
 
@@ -237,7 +349,7 @@ def supplement_phage(profile: pd.DataFrame, tax: pd.DataFrame,
     profile_phage = get_phage_from_hosts(
         profile_phage,
         profile_non_phage[profile_non_phage['kingdom'] != 'viral'], num_phage,
-        get_phages(tax))
+        phage_index or make_phage_index(tax))
 
     non_hosted = profile_phage[profile_phage['host_abundance'] == 0.]
     hosted = profile_phage[profile_phage['host_abundance'] != 0.]
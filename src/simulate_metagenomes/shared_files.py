@@ -0,0 +1,59 @@
+"""
+Functions for writing files that are shared between runs and users
+"""
+
+import os
+import stat
+import tempfile
+from typing import Tuple
+
+
+# --------------------------------------------------
+def get_umask() -> int:
+    """ Get file mode creation mask of this process """
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return umask
+
+
+# --------------------------------------------------
+def make_temp_file(dir_name: str, suffix: str) -> Tuple[int, str]:
+    """ Make temporary file to be renamed, with the permissions of a new
+    file rather than only readable by its owner """
+
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name, suffix=suffix)
+
+    try:
+        os.fchmod(fd, 0o666 & ~get_umask())
+    except OSError:
+        os.close(fd)
+        os.remove(tmp_name)
+        raise
+
+    return fd, tmp_name
+
+
+# --------------------------------------------------
+def test_make_temp_file(tmp_path) -> None:
+    """ Test make_temp_file() """
+
+    old_umask = os.umask(0o022)
+
+    try:
+        fd, tmp_name = make_temp_file(str(tmp_path), '.tmp')
+        os.close(fd)
+
+        assert os.path.dirname(tmp_name) == str(tmp_path)
+        assert tmp_name.endswith('.tmp')
+        assert stat.S_IMODE(os.stat(tmp_name).st_mode) == 0o644
+
+        os.umask(0o077)
+        fd, tmp_name = make_temp_file(str(tmp_path), '.tmp')
+        os.close(fd)
+
+        assert stat.S_IMODE(os.stat(tmp_name).st_mode) == 0o600
+
+    finally:
+        os.umask(old_umask)
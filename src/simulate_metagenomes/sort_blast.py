@@ -8,11 +8,35 @@ Purpose: Assign taxonomy to BLASTed contigs
 import argparse
 import multiprocessing as mp
 import os
-from typing import NamedTuple, TextIO
+import sys
+from collections import deque
+from itertools import chain, islice
+from typing import (Deque, Iterable, Iterator, NamedTuple, Optional, Set,
+                    TextIO)
 
+import numpy as np
 import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
 
-from blast_sorter import assign_tax
+import table_io
+from blast_sorter import assign_tax_all
+from taxonomy import index_taxonomy, load_taxonomy
+from workers import get_n_cpus
+
+# Number of hits assigned by each task
+TASK_SIZE = 100_000
+
+# Types of output columns that may be inferred differently between tasks
+DTYPES = {
+    'query_id': str,
+    'hit_id': str,
+    'e_val': float,
+    'query_length': int,
+    'alignment_length': int,
+    'start': int,
+    'end': int
+}
 
 
 class Args(NamedTuple):
@@ -20,6 +44,9 @@ class Args(NamedTuple):
     infile: TextIO
     taxonomy: TextIO
     outdir: str
+    chunk_size: int
+    threads: int
+    format: str
 
 
 # --------------------------------------------------
@@ -49,9 +76,42 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-c',
+                        '--chunk_size',
+                        metavar='INT',
+                        help='Number of hits read at a time'
+                        ' (0 for whole file); hits must be grouped by query',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('-n',
+                        '--threads',
+                        metavar='INT',
+                        help='Number of worker processes',
+                        type=int,
+                        default=get_n_cpus())
+
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.infile, args.taxonomy, args.outdir)
+    if args.threads <= 0:
+        parser.error(f'Number of threads ({args.threads})'
+                     f' must be greater than 0')
+
+    if args.chunk_size < 0:
+        parser.error(f'Chunk size ({args.chunk_size}) must not be negative')
+
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.infile, args.taxonomy, args.outdir, args.chunk_size,
+                args.threads, args.format)
 
 
 # --------------------------------------------------
@@ -79,46 +139,230 @@ def test_make_filename() -> None:
 def main() -> None:
     """ Just go for it """
 
-    n_cpu = mp.cpu_count()
-    pool = mp.Pool(n_cpu)
-    print(f'Running with {n_cpu} CPUs')
-
     args = get_args()
     out_dir = args.outdir
 
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    df = pd.read_csv(args.infile)
-    taxonomy_df = pd.read_csv(args.taxonomy)
+    by_accession = load_taxonomy(args.taxonomy.name).by_accession
 
-    assignment_df = pd.DataFrame()
-    assignments = pool.map_async(
-        assign_tax,
-        [query_hits for _, query_hits in df.groupby('query_id')]).get()
+    # Input format is taken from its extension
+    if args.chunk_size:
+        chunks = query_chunks(
+            table_io.read_table_chunks(args.infile.name, args.chunk_size))
+    else:
+        chunks = iter([table_io.read_table(args.infile)])
 
-    pool.close()
+    out_file = table_io.set_extension(
+        make_filename(args.infile.name, out_dir), args.format)
 
-    assignment_df = pd.concat([assignment_df, *assignments])
+    tasks = (task for chunk in chunks
+             for task in split_queries(chunk, TASK_SIZE))
 
-    assignment_df = assignment_df.reset_index(drop=True)
+    # Each task is appended to output once assigned
+    with table_io.TableWriter(out_file, args.format, DTYPES) as writer:
+        for assignment_df in assign_tasks(tasks, args.threads):
+            writer.write(join_taxonomy(assignment_df, by_accession))
 
-    out_df = pd.merge(assignment_df,
-                      taxonomy_df,
-                      how='inner',
-                      left_on='hit_id',
-                      right_on='accession')
+    print(f'Done. Wrote output to {out_file}')
 
-    out_df = out_df.drop_duplicates(
-        ['query_id', 'hit_id', 'taxid', 'start', 'end'])
 
-    # Rename and delete duplicate columns
+# --------------------------------------------------
+def query_chunks(chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """ Regroup chunks so all hits of a query are in the same chunk """
 
-    out_file = make_filename(args.infile.name, out_dir)
+    carry: Optional[pd.DataFrame] = None
+    seen: Set[str] = set()
 
-    out_df.to_csv(out_file, index=False)
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
 
-    print(f'Done. Wrote output to {out_file}')
+        if chunk.empty:
+            carry = chunk
+            continue
+
+        # Hits of the last query may continue in the next chunk
+        queries = chunk['query_id'].to_numpy()
+        others = np.flatnonzero(queries != queries[-1])
+        tail_start = others[-1] + 1 if len(others) else 0
+
+        if tail_start > 0:
+            yield check_grouped(chunk.iloc[:tail_start], seen)
+
+        carry = chunk.iloc[tail_start:]
+
+    if carry is not None:
+        yield check_grouped(carry, seen)
+
+
+# --------------------------------------------------
+def check_grouped(chunk: pd.DataFrame, seen: Set[str]) -> pd.DataFrame:
+    """ Exit if a query in chunk was in an earlier chunk """
+
+    queries = set(chunk['query_id'].unique())
+
+    # Hits of the query would otherwise be assigned separately
+    repeated = queries & seen
+    if repeated:
+        sys.exit(f'Error: Hits of query "{min(repeated)}" are not grouped '
+                 'together in the input.\nSort the input by query_id, or '
+                 'run without --chunk_size.')
+
+    seen.update(queries)
+
+    return chunk
+
+
+# --------------------------------------------------
+def test_query_chunks() -> None:
+    """ Test query_chunks() """
+
+    df = pd.DataFrame({'query_id': ['a', 'a', 'b', 'c', 'c', 'c', 'd']})
+
+    def chunk_queries(chunk_size: int) -> list:
+        chunks = [
+            df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)
+        ]
+        return [
+            list(chunk['query_id']) for chunk in query_chunks(iter(chunks))
+        ]
+
+    assert chunk_queries(7) == [['a', 'a', 'b', 'c', 'c', 'c'], ['d']]
+    assert chunk_queries(3) == [['a', 'a'], ['b'], ['c', 'c', 'c'], ['d']]
+    assert chunk_queries(1) == [['a', 'a'], ['b'], ['c', 'c', 'c'], ['d']]
+
+    # Empty input still gives one chunk, for the header
+    assert [len(chunk) for chunk in query_chunks(iter([df.head(0)]))] == [0]
+
+    # Hits of a query that are not grouped together are an error
+    df = pd.DataFrame({'query_id': ['a', 'b', 'b', 'a']})
+
+    with pytest.raises(SystemExit, match='query "a" are not grouped'):
+        chunk_queries(2)
+
+    with pytest.raises(SystemExit, match='query "a" are not grouped'):
+        chunk_queries(1)
+
+
+# --------------------------------------------------
+def split_queries(df: pd.DataFrame, n_hits: int) -> Iterator[pd.DataFrame]:
+    """ Split hits sorted by query into tasks of about n_hits """
+
+    if df.empty:
+        yield df
+        return
+
+    df = df.sort_values('query_id', kind='stable')
+
+    # Tasks end at the first query starting after every n_hits
+    queries = df['query_id'].to_numpy()
+    query_starts = np.flatnonzero(
+        np.concatenate(([True], queries[1:] != queries[:-1])))
+    cuts = np.unique(query_starts[np.searchsorted(
+        query_starts, np.arange(n_hits, len(df), n_hits)).clip(
+            max=len(query_starts) - 1)])
+
+    for start, end in zip([0, *cuts], [*cuts, len(df)]):
+        if end > start:
+            yield df.iloc[start:end]
+
+
+# --------------------------------------------------
+def test_split_queries() -> None:
+    """ Test split_queries() """
+
+    df = pd.DataFrame({'query_id': ['c', 'a', 'b', 'c', 'a', 'c', 'd']})
+
+    def task_queries(n_hits: int) -> list:
+        return [
+            list(task['query_id']) for task in split_queries(df, n_hits)
+        ]
+
+    assert task_queries(10) == [['a', 'a', 'b', 'c', 'c', 'c', 'd']]
+    assert task_queries(3) == [['a', 'a', 'b'], ['c', 'c', 'c'], ['d']]
+    assert task_queries(1) == [['a', 'a'], ['b'], ['c', 'c', 'c'], ['d']]
+    assert [len(task) for task in split_queries(df.head(0), 3)] == [0]
+
+
+# --------------------------------------------------
+def assign_tasks(tasks: Iterable[pd.DataFrame],
+                 threads: int) -> Iterator[pd.DataFrame]:
+    """ Assign taxonomy of each task, in order """
+
+    tasks = iter(tasks)
+    first_tasks = list(islice(tasks, 2))
+
+    # No pool is started for a single task or thread
+    if threads == 1 or len(first_tasks) < 2:
+        yield from map(assign_tax_all, chain(first_tasks, tasks))
+        return
+
+    with mp.Pool(threads) as pool:
+        queued: Deque = deque()
+
+        for task in chain(first_tasks, tasks):
+            queued.append(pool.apply_async(assign_tax_all, (task, )))
+
+            # Bound number of tasks held in memory
+            if len(queued) > 2 * threads:
+                yield queued.popleft().get()
+
+        while queued:
+            yield queued.popleft().get()
+
+
+# --------------------------------------------------
+def join_taxonomy(assignment_df: pd.DataFrame,
+                  by_accession: pd.DataFrame) -> pd.DataFrame:
+    """ Add taxonomy of assigned hits, keeping their order """
+
+    # Hits without taxonomy are dropped, as in an inner join, but a
+    # left join keeps contig order regardless of how tasks are split
+    assignment_df = assignment_df[assignment_df['hit_id'].isin(
+        by_accession.index)]
+
+    out_df = assignment_df.join(by_accession, on='hit_id', how='left')
+
+    out_df = out_df.reset_index(drop=True).drop_duplicates(
+        ['query_id', 'hit_id', 'taxid', 'start', 'end'])
+
+    return out_df
+
+
+# --------------------------------------------------
+def test_join_taxonomy() -> None:
+    """ Test join_taxonomy() """
+
+    df = pd.DataFrame(
+        [['k1_1', 'GCF_001', 0, 535, 535, 1, 535],
+         ['k1_1', 'GCF_001', 0, 535, 535, 1, 535],
+         ['k1_2', 'GCF_003', 0, 501, 501, 1, 501]],
+        columns=[
+            'query_id', 'hit_id', 'e_val', 'query_length', 'alignment_length',
+            'start', 'end'
+        ])
+    taxonomy_df = pd.DataFrame([['GCF_001', 123], ['GCF_002', 456]],
+                               columns=['accession', 'taxid'])
+
+    out_df = pd.DataFrame(
+        [['k1_1', 'GCF_001', 0, 535, 535, 1, 535, 'single', 'GCF_001', 123]],
+        columns=[
+            'query_id', 'hit_id', 'e_val', 'query_length', 'alignment_length',
+            'start', 'end', 'origin', 'accession', 'taxid'
+        ])
+
+    by_accession = index_taxonomy(taxonomy_df).by_accession
+
+    assert_frame_equal(join_taxonomy(assign_tax_all(df), by_accession),
+                       out_df)
+
+    # Same output with tasks assigned in a pool
+    tasks = list(split_queries(df, 1))
+    assert_frame_equal(
+        join_taxonomy(pd.concat(assign_tasks(tasks, 2)), by_accession),
+        out_df)
 
 
 # --------------------------------------------------
@@ -12,11 +12,14 @@ from typing import List, NamedTuple, TextIO
 import pandas as pd
 from Bio import SeqIO
 
+import table_io
+
 
 class Args(NamedTuple):
     """ Command-line arguments """
     bin_dir: str
     out_dir: str
+    format: str
 
 
 # --------------------------------------------------
@@ -39,12 +42,22 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
     if not os.path.isdir(args.bin_dir):
         parser.error(f'Input directory ("{args.bin_dir}") does not exist.')
 
-    return Args(args.bin_dir, args.out_dir)
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.bin_dir, args.out_dir, args.format)
 
 
 # --------------------------------------------------
@@ -94,7 +107,7 @@ def main() -> None:
     bins = []
     contigs = []
 
-    out_file = os.path.join(out_dir, 'bin_summary.csv')
+    out_file = os.path.join(out_dir, 'bin_summary.' + args.format)
 
     for bin_file in bin_files:
         if not bin_file:
@@ -108,7 +121,7 @@ def main() -> None:
     out_df = pd.DataFrame({'bin': bins, 'contig': contigs})
     out_df['sample'] = get_sample_name(args.bin_dir)
 
-    out_df.to_csv(out_file, index=False)
+    table_io.write_table(out_df, out_file)
 
     print(f'Done. Wrote output to {out_file}.')
 
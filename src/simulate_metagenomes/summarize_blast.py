@@ -7,10 +7,18 @@ Purpose: parse BLAST output
 
 import argparse
 from Bio.Blast import NCBIXML
+from collections import deque
+import gzip
 import io
+import multiprocessing as mp
 import os
+import pandas as pd
 import pytest
-from typing import List, NamedTuple, TextIO, Tuple
+from typing import (IO, BinaryIO, Deque, Iterable, Iterator, List, NamedTuple,
+                    TextIO, Tuple, cast)
+
+import table_io
+from workers import get_n_cpus
 
 
 class Args(NamedTuple):
@@ -18,6 +26,8 @@ class Args(NamedTuple):
     blast_out: TextIO
     outdir: str
     low_mem: bool
+    threads: int
+    format: str
 
 
 class Hit(NamedTuple):
@@ -31,6 +41,38 @@ class Hit(NamedTuple):
     end: str
 
 
+class Shards(NamedTuple):
+    """ Byte ranges of BLAST XML holding whole iterations """
+    header: bytes
+    bounds: List[Tuple[int, int]]
+    footer: bytes
+
+
+# Columns of tabular input made with
+# -outfmt "6 qseqid sseqid evalue qlen length qstart qend" (or 7)
+TAB_COLUMNS = [
+    'query_id', 'hit_id', 'e_val', 'query_length', 'alignment_length',
+    'start', 'end'
+]
+# Column types of output tables
+DTYPES = {
+    'query_id': str,
+    'hit_id': str,
+    'e_val': float,
+    'query_length': int,
+    'alignment_length': int,
+    'start': int,
+    'end': int
+}
+TAB_CHUNK_SIZE = 1_000_000
+TAB_CHUNK_SIZE_LOW_MEM = 10_000
+
+# Approximate size of XML parsed by each worker
+SHARD_SIZE = 64 * 1024**2
+ITERATION_TAG = b'<Iteration>'
+ITERATIONS_END_TAG = b'</BlastOutput_iterations>'
+
+
 # --------------------------------------------------
 def get_args() -> Args:
     """ Get command-line arguments """
@@ -41,8 +83,8 @@ def get_args() -> Args:
 
     parser.add_argument('blast_out',
                         metavar='FILE',
-                        type=argparse.FileType('rt'),
-                        help='BLAST output')
+                        type=open_blast,
+                        help='BLAST output, XML or tabular (may be gzipped)')
 
     parser.add_argument('-o',
                         '--outdir',
@@ -56,9 +98,32 @@ def get_args() -> Args:
                         action='store_true',
                         help='Use low-memory, slower version')
 
+    parser.add_argument('-n',
+                        '--threads',
+                        metavar='INT',
+                        help='Number of worker processes'
+                        ' (uncompressed XML only)',
+                        type=int,
+                        default=get_n_cpus())
+
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.blast_out, args.outdir, args.low_mem)
+    if args.threads <= 0:
+        parser.error(f'Number of threads ({args.threads})'
+                     f' must be greater than 0')
+
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.blast_out, args.outdir, args.low_mem, args.threads,
+                args.format)
 
 
 # --------------------------------------------------
@@ -70,25 +135,115 @@ def main() -> None:
     if not os.path.isdir(args.outdir):
         os.mkdir(args.outdir)
 
-    out_file = make_filename(args.outdir, args.blast_out.name)
+    out_file = table_io.set_extension(
+        make_filename(args.outdir, args.blast_out.name), args.format)
 
-    hits = get_hits(args.blast_out)
     header = 'query_id,hit_id,e_val,query_length,alignment_length,start,end'
 
-    with open(out_file, 'wt') as out_fh:
-        if args.low_mem:
-            output_low_mem(header, hits, out_fh)
+    with open_output(out_file, args.format) as out_fh:
+        if not is_xml(args.blast_out):
+            chunk_size = TAB_CHUNK_SIZE_LOW_MEM if args.low_mem \
+                else TAB_CHUNK_SIZE
+            output_tabular(header, args.blast_out, out_fh, chunk_size)
+        elif args.low_mem:
+            output_low_mem(header, get_hits(args.blast_out), out_fh)
+        elif args.threads == 1 or is_gzip(args.blast_out.name):
+            output_fast(header, get_hits(args.blast_out), out_fh)
         else:
-            output_fast(header, hits, out_fh)
+            output_parallel(header, args.blast_out.name, out_fh, args.threads)
+
+    args.blast_out.close()
 
     print(f'Done. Wrote output to {out_file}.')
 
 
+# --------------------------------------------------
+def is_gzip(filename: str) -> bool:
+    """ Check if file is gzip-compressed """
+
+    with open(filename, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
+
+
+# --------------------------------------------------
+def open_blast(filename: str) -> TextIO:
+    """ Open BLAST output, which may be gzip-compressed """
+
+    try:
+        if is_gzip(filename):
+            return gzip.open(filename, 'rt')  # type: ignore
+
+        return open(filename, 'rt')
+
+    except OSError as err:
+        raise argparse.ArgumentTypeError(
+            f"can't open '{filename}': {err}") from err
+
+
+# --------------------------------------------------
+def test_open_blast(tmp_path) -> None:
+    """ Test open_blast() """
+
+    text = '<?xml version="1.0"?>\n'
+    plain = tmp_path / 'plain.xml'
+    plain.write_text(text)
+    zipped = tmp_path / 'zipped.xml.gz'
+    with gzip.open(zipped, 'wt') as out_fh:
+        out_fh.write(text)
+
+    for filename in [str(plain), str(zipped)]:
+        with open_blast(filename) as fh:
+            assert fh.name == filename
+            assert fh.read() == text
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        open_blast(str(tmp_path / 'missing.xml'))
+
+
+# --------------------------------------------------
+def is_xml(fh: TextIO) -> bool:
+    """ Check if BLAST output is XML rather than tabular, and rewind """
+
+    first_line = fh.readline()
+    fh.seek(0)
+
+    return first_line.lstrip().startswith('<')
+
+
+# --------------------------------------------------
+def test_is_xml() -> None:
+    """ Test is_xml() """
+
+    xml = io.StringIO('<?xml version="1.0"?>\n<BlastOutput>\n')
+    assert is_xml(xml)
+    assert xml.tell() == 0
+
+    assert not is_xml(io.StringIO('k141_5989\tGCF_002148255.1\t0.0\n'))
+    assert not is_xml(io.StringIO('# BLASTN 2.12.0+\n'))
+    assert not is_xml(io.StringIO(''))
+
+
+# --------------------------------------------------
+def open_output(filename: str, fmt: str) -> TextIO:
+    """ Open output file, parsing CSV text into other table formats """
+
+    if fmt == 'csv':
+        return open(filename, 'wt')
+
+    return cast(TextIO,
+                table_io.CsvTextWriter(
+                    table_io.TableWriter(filename, fmt, DTYPES), DTYPES))
+
+
 # --------------------------------------------------
 def make_filename(out_dir: str, infile: str) -> str:
     """ Create output file name """
 
-    root, _ = os.path.splitext(os.path.basename(infile))
+    root = os.path.basename(infile)
+    if root.endswith('.gz'):
+        root = root[:-3]
+
+    root, _ = os.path.splitext(root)
     name = root.replace('blast_out', '')
 
     return os.path.join(out_dir, name + 'parsed_blast.csv')
@@ -101,17 +256,18 @@ def test_make_filenames() -> None:
     file_name = 'out/input_1_parsed_blast.csv'
     assert make_filename('out', 'input_1_blast_out.txt') == file_name
     assert make_filename('out', 'tests/input_1_blast_out.txt') == file_name
+    assert make_filename('out', 'input_1_blast_out.xml.gz') == file_name
 
 
 # --------------------------------------------------
-def get_hits(infile: TextIO) -> List[Hit]:
-    """ Parse BLAST output for hits """
+def get_hits(infile: IO) -> Iterator[List[Hit]]:
+    """ Parse BLAST output, yielding the hits of one query at a time """
 
-    hits = []
     for query in NCBIXML.parse(infile):
         query_id = query.query.split(" ")[0]
         query_length = query.query.split(" ")[3].replace('len=', '')
 
+        hits = []
         for alignment in query.alignments:
             hit_id = alignment.hit_def
 
@@ -122,21 +278,207 @@ def get_hits(infile: TextIO) -> List[Hit]:
 
                 hits.append(hit)
 
-    return hits
+        yield hits
 
 
 # --------------------------------------------------
-def output_low_mem(header: str, hits: List[Hit], fh: TextIO) -> None:
-    """ Create output using less memory, but slower """
+def test_get_hits() -> None:
+    """ Test get_hits() """
+
+    xml = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests',
+                       'inputs', 'summarize_blast', 'input_1_blast_out.xml')
+
+    with open(xml) as fh:
+        queries = list(get_hits(fh))
+
+    first, second = queries[:2]
+    assert {hit.query_id for hit in first} == {'k141_5989'}
+    assert ','.join(map(str, first[0])) == (
+        'k141_5989,GCF_002148255.1,8.40553e-160,306,306,1,306')
+    assert second[0].query_id == 'k141_7797'
+    assert sum(map(len, queries)) == 24
+
+
+# --------------------------------------------------
+def find_tag(fh: BinaryIO,
+             tag: bytes,
+             start: int,
+             block_size: int = 1024**2) -> int:
+    """ Find offset of the first tag at or after start, or -1 """
+
+    fh.seek(start)
+    offset = start
+    carry = b''
+
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            return -1
+
+        # Carry the end of the last block in case a tag spans two blocks
+        buf = carry + block
+        pos = buf.find(tag)
+        if pos >= 0:
+            return offset - len(carry) + pos
+
+        carry = buf[1 - len(tag):]
+        offset += len(block)
+
+
+# --------------------------------------------------
+def test_find_tag() -> None:
+    """ Test find_tag() """
+
+    fh = io.BytesIO(b'<a><Iteration><b></b><Iteration>')
+
+    assert find_tag(fh, b'<Iteration>', 0) == 3
+    assert find_tag(fh, b'<Iteration>', 3) == 3
+    assert find_tag(fh, b'<Iteration>', 4) == 21
+    assert find_tag(fh, b'<Iteration>', 22) == -1
+    assert find_tag(fh, b'<Iteration>', 100) == -1
+
+    # Tags spanning blocks are found
+    for block_size in range(1, 12):
+        assert find_tag(fh, b'<Iteration>', 4, block_size) == 21
+
+
+# --------------------------------------------------
+def get_shards(fh: BinaryIO, shard_size: int = SHARD_SIZE) -> Shards:
+    """ Split BLAST XML at iteration boundaries """
+
+    size = fh.seek(0, os.SEEK_END)
+
+    # Iterations end where the closing tag is, or at the end of a
+    # truncated file, which then fails to parse as it would serially
+    tail_start = max(0, size - 1024**2)
+    fh.seek(tail_start)
+    end_pos = fh.read().rfind(ITERATIONS_END_TAG)
+    iterations_end = tail_start + end_pos if end_pos >= 0 else size
+
+    first = find_tag(fh, ITERATION_TAG, 0)
+    if first < 0:
+        return Shards(b'', [], b'')
+
+    fh.seek(0)
+    header = fh.read(first)
+    fh.seek(iterations_end)
+    footer = fh.read()
+
+    starts = [first]
+    while True:
+        start = find_tag(fh, ITERATION_TAG, starts[-1] + shard_size)
+        if start < 0 or start >= iterations_end:
+            break
+        starts.append(start)
+
+    bounds = list(zip(starts, starts[1:] + [iterations_end]))
+
+    return Shards(header, bounds, footer)
+
+
+# --------------------------------------------------
+def test_get_shards() -> None:
+    """ Test get_shards() """
+
+    xml = (b'<BlastOutput><BlastOutput_iterations>'
+           b'<Iteration>1</Iteration>'
+           b'<Iteration>2</Iteration>'
+           b'<Iteration>3</Iteration>'
+           b'</BlastOutput_iterations></BlastOutput>')
+    fh = io.BytesIO(xml)
+
+    header = b'<BlastOutput><BlastOutput_iterations>'
+    footer = b'</BlastOutput_iterations></BlastOutput>'
+
+    # One shard when shards are larger than the file
+    assert get_shards(fh) == Shards(header, [(37, 109)], footer)
+
+    # Otherwise shards hold at least one whole iteration
+    assert get_shards(fh, 1) == Shards(header, [(37, 61), (61, 85),
+                                                (85, 109)], footer)
+    assert get_shards(fh, 25) == Shards(header, [(37, 85), (85, 109)],
+                                        footer)
+
+    # No iterations
+    fh = io.BytesIO(b'<BlastOutput></BlastOutput>')
+    assert get_shards(fh) == Shards(b'', [], b'')
+
+
+# --------------------------------------------------
+def parse_shard(filename: str, header: bytes, start: int, end: int,
+                footer: bytes) -> str:
+    """ Parse iterations between two offsets, returning output rows """
+
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        body = fh.read(end - start)
+
+    xml = io.BytesIO(header + body + footer)
+
+    return ''.join(map(format_hits, get_hits(xml)))
+
+
+# --------------------------------------------------
+def parse_shards(filename: str, shards: Shards,
+                 threads: int) -> Iterator[str]:
+    """ Parse shards of BLAST XML, yielding output rows in order """
+
+    tasks = [(filename, shards.header, start, end, shards.footer)
+             for start, end in shards.bounds]
+
+    # No pool is started for a single shard or thread
+    if threads == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield parse_shard(*task)
+        return
+
+    with mp.Pool(threads) as pool:
+        queued: Deque = deque()
+
+        for task in tasks:
+            queued.append(pool.apply_async(parse_shard, task))
+
+            # Bound number of parsed shards held in memory
+            if len(queued) > 2 * threads:
+                yield queued.popleft().get()
+
+        while queued:
+            yield queued.popleft().get()
+
+
+# --------------------------------------------------
+def test_parse_shards() -> None:
+    """ Test parse_shards() """
+
+    xml = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests',
+                       'inputs', 'summarize_blast', 'input_1_blast_out.xml')
+
+    with open(xml) as fh:
+        expected = ''.join(map(format_hits, get_hits(fh)))
+
+    with open(xml, 'rb') as fh:
+        shards = get_shards(fh, 1000)
+
+    assert len(shards.bounds) > 2
+
+    for threads in [1, 2]:
+        assert ''.join(parse_shards(xml, shards, threads)) == expected
+
+
+# --------------------------------------------------
+def output_low_mem(header: str, queries: Iterable[List[Hit]],
+                   fh: TextIO) -> None:
+    """ Create output one hit at a time, using less memory, but slower """
 
     fh.write(header)
 
-    for hit in hits:
-        print(
-            f'\n{hit.query_id},{hit.hit_id},{hit.e_val},{hit.query_length},'
-            f'{hit.align_length},{hit.start},{hit.end}',
-            file=fh,
-            end='')
+    for hits in queries:
+        for hit in hits:
+            print(
+                f'\n{hit.query_id},{hit.hit_id},{hit.e_val},'
+                f'{hit.query_length},{hit.align_length},{hit.start},{hit.end}',
+                file=fh,
+                end='')
     fh.write('\n')
 
 
@@ -148,7 +490,7 @@ def test_output_low_mem(example_out_data: Tuple[str, List[Hit]],
     header, hits = example_out_data
     out_fh = io.StringIO('')
 
-    output_low_mem(header, hits, out_fh)
+    output_low_mem(header, [hits[:1], [], hits[1:]], out_fh)
 
     out_fh.seek(0)
 
@@ -156,17 +498,29 @@ def test_output_low_mem(example_out_data: Tuple[str, List[Hit]],
 
 
 # --------------------------------------------------
-def output_fast(header: str, hits: List[Hit], fh: TextIO) -> None:
-    """ Create output fast, but with more memory usage """
+def output_fast(header: str, queries: Iterable[List[Hit]],
+                fh: TextIO) -> None:
+    """ Create output one query at a time, fast, but with more memory """
 
     fh.write(header + '\n')
 
+    for hits in queries:
+        fh.write(format_hits(hits))
+
+
+# --------------------------------------------------
+def format_hits(hits: List[Hit]) -> str:
+    """ Format hits as output rows """
+
+    if not hits:
+        return ''
+
     hits_str = [
         f'{hit.query_id},{hit.hit_id},{hit.e_val},{hit.query_length},'
         f'{hit.align_length},{hit.start},{hit.end}' for hit in hits
     ]
 
-    fh.write('\n'.join(hits_str) + '\n')
+    return '\n'.join(hits_str) + '\n'
 
 
 # --------------------------------------------------
@@ -177,12 +531,80 @@ def test_output_fast(example_out_data: Tuple[str, List[Hit]],
     header, hits = example_out_data
     out_fh = io.StringIO('')
 
-    output_fast(header, hits, out_fh)
+    output_fast(header, [hits[:1], [], hits[1:]], out_fh)
+
+    out_fh.seek(0)
+
+    assert out_fh.read() == example_out.read()
+
+
+# --------------------------------------------------
+def output_parallel(header: str,
+                    filename: str,
+                    fh: TextIO,
+                    threads: int,
+                    shard_size: int = SHARD_SIZE) -> None:
+    """ Create output parsing shards of the XML in parallel """
+
+    fh.write(header + '\n')
+
+    with open(filename, 'rb') as in_fh:
+        shards = get_shards(in_fh, shard_size)
+
+    for rows in parse_shards(filename, shards, threads):
+        fh.write(rows)
+
+
+# --------------------------------------------------
+def output_tabular(header: str,
+                   in_fh: TextIO,
+                   fh: TextIO,
+                   chunk_size: int = TAB_CHUNK_SIZE) -> None:
+    """ Create output from tabular (outfmt 6 or 7) BLAST output """
+
+    fh.write(header + '\n')
+
+    chunks = pd.read_csv(in_fh,
+                         sep='\t',
+                         comment='#',
+                         header=None,
+                         names=TAB_COLUMNS,
+                         usecols=range(len(TAB_COLUMNS)),
+                         dtype=str,
+                         chunksize=chunk_size)
+
+    for chunk in chunks:
+        chunk.to_csv(fh, header=False, index=False)
+
+
+# --------------------------------------------------
+def test_output_tabular(example_out_data: Tuple[str, List[Hit]],
+                        example_out: TextIO) -> None:
+    """ Test output_tabular() """
+
+    header, _ = example_out_data
+    in_fh = io.StringIO(
+        '# BLASTN 2.12.0+\n'
+        '# Query: k141_5989 flag=1 multi=2.0000 len=306\n'
+        '# Fields: query id, subject id, evalue, query length, '
+        'alignment length, q. start, q. end\n'
+        '# 2 hits found\n'
+        'k141_5989\tGCF_002148255.1\t8.40553e-160\t306\t306\t1\t306\n'
+        'k141_5989\tGCF_009834925.2\t2.71137e-55\t306\t208\t70\t275\n'
+        '# BLAST processed 1 queries\n')
+    out_fh = io.StringIO('')
+
+    output_tabular(header, in_fh, out_fh, chunk_size=1)
 
     out_fh.seek(0)
 
     assert out_fh.read() == example_out.read()
 
+    # No hits
+    out_fh = io.StringIO('')
+    output_tabular(header, io.StringIO(''), out_fh)
+    assert out_fh.getvalue() == header + '\n'
+
 
 # --------------------------------------------------
 @pytest.fixture(name='example_out_data')
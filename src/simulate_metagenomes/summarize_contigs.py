@@ -8,16 +8,19 @@ Purpose: Get lengths of all contigs
 import argparse
 import io
 import os
-from typing import NamedTuple, TextIO
+from typing import NamedTuple, TextIO, cast
 
 from Bio import SeqIO
 
+import table_io
+
 
 class Args(NamedTuple):
     """ Command-line arguments """
     contigs: TextIO
     filename: str
     outdir: str
+    format: str
 
 
 # --------------------------------------------------
@@ -47,9 +50,19 @@ def get_args() -> Args:
                         help='Output directory',
                         default='out')
 
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.contigs, args.filename, args.outdir)
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.contigs, args.filename, args.outdir, args.format)
 
 
 # --------------------------------------------------
@@ -62,21 +75,21 @@ def main() -> None:
     if not os.path.isdir(args.outdir):
         os.mkdir(args.outdir)
 
-    out_file = make_filename(args.outdir, args.filename)
+    out_file = make_filename(args.outdir, args.filename, args.format)
 
-    with open(out_file, 'wt') as out_fh:
+    with open_output(out_file, args.format) as out_fh:
         summarize_contigs(in_fh, out_fh)
 
     print(f'Done. Wrote output to {out_file}')
 
 
 # --------------------------------------------------
-def make_filename(out_dir: str, filename: str) -> str:
+def make_filename(out_dir: str, filename: str, fmt: str = 'csv') -> str:
     """ Create output file name """
 
     _, ext = os.path.splitext(filename)
-    if not ext:
-        filename = filename + '.csv'
+    if not ext or fmt != 'csv':
+        filename = table_io.set_extension(filename, fmt)
 
     return os.path.join(out_dir, filename)
 
@@ -92,6 +105,27 @@ def test_make_filenames() -> None:
     # Assume filename extension
     assert make_filename('out', 'contig_summary') == 'out/contig_summary.csv'
 
+    # Extension of other formats
+    assert make_filename('out', 'contig_summary',
+                         'parquet') == 'out/contig_summary.parquet'
+    assert make_filename('out', 'contig_summary.csv',
+                         'feather') == 'out/contig_summary.feather'
+
+
+# --------------------------------------------------
+def open_output(filename: str, fmt: str) -> TextIO:
+    """ Open output file, parsing CSV text into other table formats """
+
+    if fmt == 'csv':
+        return open(filename, 'wt')
+
+    dtype = {'contig_id': str, 'length': int}
+
+    return cast(
+        TextIO,
+        table_io.CsvTextWriter(table_io.TableWriter(filename, fmt, dtype),
+                               dtype))
+
 
 # --------------------------------------------------
 def summarize_contigs(in_fh: TextIO, out_fh: TextIO) -> None:
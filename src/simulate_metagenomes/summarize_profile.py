@@ -10,6 +10,8 @@ from pandas.testing import assert_frame_equal
 import bracken_profiler
 import os
 import pandas as pd
+import table_io
+import taxonomy
 from typing import NamedTuple, TextIO
 
 
@@ -19,6 +21,7 @@ class Args(NamedTuple):
     profile: TextIO
     taxonomy: TextIO
     outdir: str
+    format: str
 
 
 # --------------------------------------------------
@@ -57,9 +60,20 @@ def get_args() -> Args:
                         type=str,
                         default='out')
 
+    parser.add_argument('-F',
+                        '--format',
+                        help='Output table format',
+                        choices=table_io.FORMATS,
+                        default='csv')
+
     args = parser.parse_args()
 
-    return Args(args.bracken, args.profile, args.taxonomy, args.outdir)
+    format_error = table_io.check_format(args.format)
+    if format_error:
+        parser.error(format_error)
+
+    return Args(args.bracken, args.profile, args.taxonomy, args.outdir,
+                args.format)
 
 
 # --------------------------------------------------
@@ -79,7 +93,8 @@ def main() -> None:
     bracken_df = bracken_profiler.clean_bracken(
         pd.read_csv(bracken_profile, sep='\t'))
 
-    taxonomy_df = bracken_profiler.clean_taxonomy(pd.read_csv(args.taxonomy))
+    taxonomy_df = bracken_profiler.clean_taxonomy(
+        taxonomy.load_taxonomy(args.taxonomy.name).by_taxid)
 
     joined_df = bracken_profiler.join_dfs(bracken_df,
                                           taxonomy_df,
@@ -92,9 +107,10 @@ def main() -> None:
 
     joined_profiles = join_profiles(joined_df, profile_df)
 
-    out_file = make_filename(out_dir, bracken_profile.name)
+    out_file = table_io.set_extension(
+        make_filename(out_dir, bracken_profile.name), args.format)
 
-    joined_profiles.to_csv(out_file, index=False)
+    table_io.write_table(joined_profiles, out_file)
 
     print(f'Done. Wrote output to {out_file}.')
 
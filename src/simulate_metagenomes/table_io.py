@@ -0,0 +1,449 @@
+"""
+Functions for reading and writing tables as CSV, Parquet, or Feather
+"""
+
+import importlib.util
+import io
+import os
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Union
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+FORMATS = ['csv', 'parquet', 'feather']
+
+# Text columns with few distinct values, stored as categoricals
+CATEGORICAL_COLUMNS = ['kingdom', 'profile', 'model', 'step']
+
+TableFile = Union[str, TextIO]
+
+
+# --------------------------------------------------
+def check_format(fmt: str) -> Optional[str]:
+    """ Get reason a table format cannot be used, if any """
+
+    if fmt != 'csv' and importlib.util.find_spec('pyarrow') is None:
+        return f'Format "{fmt}" requires pyarrow to be installed'
+
+    return None
+
+
+# --------------------------------------------------
+def get_format(filename: str) -> str:
+    """ Get table format from file extension, defaulting to CSV """
+
+    _, ext = os.path.splitext(filename)
+    fmt = ext.lstrip('.').lower()
+
+    return fmt if fmt in FORMATS else 'csv'
+
+
+# --------------------------------------------------
+def test_get_format() -> None:
+    """ Test get_format() """
+
+    assert get_format('out/input_1_parsed_blast.csv') == 'csv'
+    assert get_format('out/input_1_parsed_blast.parquet') == 'parquet'
+    assert get_format('out/input_1_parsed_blast.feather') == 'feather'
+    assert get_format('out/input_1_profile.txt') == 'csv'
+    assert get_format('out/contig_summary') == 'csv'
+
+
+# --------------------------------------------------
+def set_extension(filename: str, fmt: str) -> str:
+    """ Give filename the extension of a table format """
+
+    root, ext = os.path.splitext(filename)
+
+    # Other extensions may be part of the name, e.g. 'WGS_1.5'
+    if ext.lstrip('.').lower() not in FORMATS:
+        root = filename
+
+    return f'{root}.{fmt}'
+
+
+# --------------------------------------------------
+def test_set_extension() -> None:
+    """ Test set_extension() """
+
+    assert set_extension('out/summary.csv', 'csv') == 'out/summary.csv'
+    assert set_extension('out/summary.csv', 'parquet') == \
+        'out/summary.parquet'
+    assert set_extension('out/summary.feather', 'csv') == 'out/summary.csv'
+    assert set_extension('out/summary', 'feather') == 'out/summary.feather'
+    assert set_extension('out/WGS_1.5', 'csv') == 'out/WGS_1.5.csv'
+
+
+# --------------------------------------------------
+def categorize(df: pd.DataFrame) -> pd.DataFrame:
+    """ Store low-cardinality text columns as categoricals """
+
+    cols = [
+        col for col in CATEGORICAL_COLUMNS
+        if col in df.columns and df[col].dtype == object
+    ]
+
+    return df.astype({col: 'category' for col in cols}) if cols else df
+
+
+# --------------------------------------------------
+def test_categorize() -> None:
+    """ Test categorize() """
+
+    df = pd.DataFrame({
+        'accession': ['GCF_001', 'GCF_002'],
+        'kingdom': ['Bacteria', 'Viruses'],
+        'taxid': [1, 2]
+    })
+
+    out_df = categorize(df)
+
+    assert out_df['kingdom'].dtype == 'category'
+    assert out_df['accession'].dtype == object
+    assert out_df['taxid'].dtype == 'int64'
+    assert list(out_df['kingdom']) == ['Bacteria', 'Viruses']
+
+
+# --------------------------------------------------
+def read_table(file: TableFile, **kwargs: Any) -> pd.DataFrame:
+    """ Read table, keyword arguments are only used for CSV """
+
+    filename = file if isinstance(file, str) else file.name
+    fmt = get_format(filename)
+
+    if fmt == 'parquet':
+        return pd.read_parquet(filename)
+
+    if fmt == 'feather':
+        return pd.read_feather(filename)
+
+    return pd.read_csv(file, **kwargs)
+
+
+# --------------------------------------------------
+def read_table_chunks(filename: str,
+                      chunk_size: int) -> Iterator[pd.DataFrame]:
+    """ Read table in chunks of about chunk_size rows """
+
+    fmt = get_format(filename)
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq  # type: ignore
+
+        for batch in pq.ParquetFile(filename).iter_batches(chunk_size):
+            yield batch.to_pandas()
+
+    # Feather is memory-mapped, so is read at once then split
+    elif fmt == 'feather':
+        df = pd.read_feather(filename)
+
+        for start in range(0, max(len(df), 1), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+    else:
+        yield from pd.read_csv(filename, chunksize=chunk_size)
+
+
+# --------------------------------------------------
+def write_table(df: pd.DataFrame,
+                filename: str,
+                fmt: Optional[str] = None) -> None:
+    """ Write whole table, in format of the file extension by default """
+
+    fmt = fmt or get_format(filename)
+
+    if fmt == 'parquet':
+        categorize(df).to_parquet(filename, index=False)
+    elif fmt == 'feather':
+        categorize(df).reset_index(drop=True).to_feather(filename)
+    else:
+        df.to_csv(filename, index=False)
+
+
+# --------------------------------------------------
+def arrow_schema(df: pd.DataFrame, dtype: Dict[str, Any]) -> Any:
+    """ Schema for all parts of a table, from its first part """
+
+    import pyarrow as pa  # type: ignore
+
+    types = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+
+    # Given types are used, e.g. for floats that are whole numbers in the
+    # first part, and columns with no values are assumed to be text
+    fields = []
+    for field in schema:
+        if field.name in dtype and dtype[field.name] in types:
+            field = field.with_type(types[dtype[field.name]])
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+
+    return pa.schema(fields)
+
+
+# --------------------------------------------------
+class TableWriter:
+    """ Write a table in parts, with column types if given """
+
+    def __init__(self,
+                 filename: str,
+                 fmt: Optional[str] = None,
+                 dtype: Optional[Dict[str, Any]] = None) -> None:
+        self.filename = filename
+        self.fmt = fmt or get_format(filename)
+        self.dtype = dtype or {}
+        self.n_parts = 0
+        self.parts: List[pd.DataFrame] = []
+        self.writer: Any = None
+
+    def __enter__(self) -> 'TableWriter':
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def write(self, df: pd.DataFrame) -> None:
+        """ Write part of the table """
+
+        if self.fmt == 'parquet':
+            self.write_parquet(categorize(df))
+
+        # Feather files cannot be appended to
+        elif self.fmt == 'feather':
+            self.parts.append(df)
+
+        else:
+            df.to_csv(self.filename,
+                      index=False,
+                      mode='a' if self.n_parts else 'w',
+                      header=not self.n_parts)
+
+        self.n_parts += 1
+
+    def write_parquet(self, df: pd.DataFrame) -> None:
+        """ Write part of the table as a Parquet row group """
+
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename,
+                                           arrow_schema(df, self.dtype))
+
+        table = pa.Table.from_pandas(df,
+                                     schema=self.writer.schema,
+                                     preserve_index=False)
+
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        """ Finish writing the table """
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.parts:
+            write_table(pd.concat(self.parts, ignore_index=True),
+                        self.filename, 'feather')
+            self.parts = []
+
+
+# --------------------------------------------------
+class CsvTextWriter(io.TextIOBase):
+    """ Text file that parses CSV written to it into a typed table """
+
+    def __init__(self,
+                 writer: TableWriter,
+                 dtype: Dict[str, Any],
+                 buffer_size: int = 64 * 1024**2) -> None:
+        super().__init__()
+        self.writer = writer
+        self.dtype = dtype
+        self.buffer_size = buffer_size
+        self.lines: List[str] = []
+        self.size = 0
+        self.names: Optional[List[str]] = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        """ Write CSV text, the first line being the header """
+
+        self.lines.append(text)
+        self.size += len(text)
+
+        if self.size >= self.buffer_size:
+            self.write_lines()
+
+        return len(text)
+
+    def write_lines(self, final: bool = False) -> None:
+        """ Write complete lines of buffered text to the table """
+
+        text = ''.join(self.lines)
+
+        # An incomplete last line is kept for later
+        end = len(text) if final else text.rfind('\n') + 1
+        self.lines = [text[end:]] if text[end:] else []
+        self.size = len(text) - end
+        text = text[:end]
+
+        if self.names is None:
+            if not text:
+                return
+            header, _, text = text.partition('\n')
+            self.names = header.split(',')
+
+        if text.strip():
+            self.writer.write(
+                pd.read_csv(io.StringIO(text),
+                            header=None,
+                            names=self.names,
+                            dtype=self.dtype))
+
+        elif final and not self.writer.n_parts:
+            self.writer.write(
+                pd.DataFrame({
+                    name: pd.Series([], dtype=self.dtype.get(name, object))
+                    for name in self.names
+                }))
+
+    def close(self) -> None:
+        """ Write remaining text and finish the table """
+
+        if not self.closed:
+            self.write_lines(final=True)
+            self.writer.close()
+
+        super().close()
+
+
+# --------------------------------------------------
+@pytest.fixture(name='example_df')
+def fixture_example_df() -> pd.DataFrame:
+    """ Example table with several column types """
+
+    return pd.DataFrame({
+        'query_id': ['k141_5989', 'k141_5989', 'k141_7797'],
+        'hit_id': ['GCF_002148255.1', 'GCF_009834925.2', 'GCF_013393365.1'],
+        'e_val': [8.40553e-160, 2.71137e-55, 0.0],
+        'taxid': [1, 2, 3],
+        'kingdom': ['Bacteria', 'Viruses', 'Bacteria']
+    })
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_write_table(tmp_path, example_df: pd.DataFrame, fmt: str) -> None:
+    """ Test write_table() and read_table() """
+
+    if fmt != 'csv':
+        pytest.importorskip('pyarrow')
+
+    filename = str(tmp_path / f'table.{fmt}')
+
+    write_table(example_df, filename)
+    out_df = read_table(filename)
+
+    if fmt == 'csv':
+        assert_frame_equal(out_df, example_df)
+    else:
+        assert_frame_equal(out_df, categorize(example_df))
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_table_writer(tmp_path, example_df: pd.DataFrame, fmt: str) -> None:
+    """ Test TableWriter and read_table_chunks() """
+
+    if fmt != 'csv':
+        pytest.importorskip('pyarrow')
+
+    filename = str(tmp_path / f'table.{fmt}')
+
+    with TableWriter(filename) as writer:
+        writer.write(example_df.iloc[:2])
+        writer.write(example_df.iloc[2:])
+
+    expected = example_df if fmt == 'csv' else categorize(example_df)
+
+    assert_frame_equal(read_table(filename), expected)
+
+    chunks = list(read_table_chunks(filename, 2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+
+    # Chunks may have different categories
+    out_df = pd.concat(chunks, ignore_index=True)
+    if fmt != 'csv':
+        out_df = categorize(out_df)
+
+    assert_frame_equal(out_df, expected)
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_table_writer_types(tmp_path, fmt: str) -> None:
+    """ Test TableWriter with column types changing between parts """
+
+    if fmt != 'csv':
+        pytest.importorskip('pyarrow')
+
+    filename = str(tmp_path / f'table.{fmt}')
+
+    with TableWriter(filename, dtype={'e_val': float}) as writer:
+        writer.write(
+            pd.DataFrame({
+                'species': [None],
+                'e_val': [0],
+                'taxid': [1]
+            }))
+        writer.write(
+            pd.DataFrame({
+                'species': ['Escherichia coli'],
+                'e_val': [1.5e-10],
+                'taxid': [2]
+            }))
+
+    out_df = read_table(filename)
+
+    assert list(out_df['species']) == [None, 'Escherichia coli'] or \
+        fmt == 'csv'
+    assert list(out_df['e_val']) == [0., 1.5e-10]
+    assert list(out_df['taxid']) == [1, 2]
+    assert out_df['taxid'].dtype == 'int64'
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_csv_text_writer(tmp_path, example_df: pd.DataFrame,
+                         fmt: str) -> None:
+    """ Test CsvTextWriter """
+
+    if fmt != 'csv':
+        pytest.importorskip('pyarrow')
+
+    filename = str(tmp_path / f'table.{fmt}')
+    text = example_df.to_csv(index=False)
+    dtype = {'e_val': float, 'taxid': int, 'kingdom': str}
+
+    # Text is split at any point
+    with CsvTextWriter(TableWriter(filename), dtype, buffer_size=10) as fh:
+        for i in range(0, len(text), 7):
+            fh.write(text[i:i + 7])
+
+    expected = example_df if fmt == 'csv' else categorize(example_df)
+
+    assert_frame_equal(read_table(filename), expected)
+
+    # Header only
+    with CsvTextWriter(TableWriter(filename), dtype) as fh:
+        fh.write(text.split('\n')[0] + '\n')
+
+    out_df = read_table(filename)
+
+    assert list(out_df.columns) == list(example_df.columns)
+    assert out_df.empty
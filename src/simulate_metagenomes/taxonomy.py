@@ -0,0 +1,256 @@
+"""
+Load the taxonomy mapping file, using a binary cache while it is current
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+from typing import NamedTuple, Optional
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import table_io
+from shared_files import get_umask, make_temp_file
+
+# Increase when the cached contents change
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.cache'
+
+
+class Taxonomy(NamedTuple):
+    """ Taxonomy table, with rows indexed by taxid and accession """
+    df: pd.DataFrame
+    by_taxid: pd.DataFrame
+    by_accession: pd.DataFrame
+
+
+class FileKey(NamedTuple):
+    """ Modification time and size of a file """
+    mtime_ns: int
+    size: int
+
+
+# --------------------------------------------------
+def get_file_key(filename: str) -> FileKey:
+    """ Get modification time and size of a file """
+
+    stat = os.stat(filename)
+
+    return FileKey(stat.st_mtime_ns, stat.st_size)
+
+
+# --------------------------------------------------
+def hash_file(filename: str, block_size: int = 1024**2) -> str:
+    """ Get SHA-256 digest of file contents """
+
+    digest = hashlib.sha256()
+
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def test_hash_file(tmp_path) -> None:
+    """ Test hash_file() """
+
+    filename = str(tmp_path / 'taxonomy.csv')
+    with open(filename, 'wt') as fh:
+        fh.write('accession,taxid\n')
+
+    assert hash_file(filename, block_size=4) == hash_file(filename)
+    assert hash_file(filename) == hashlib.sha256(
+        b'accession,taxid\n').hexdigest()
+
+
+# --------------------------------------------------
+def index_taxonomy(df: pd.DataFrame) -> Taxonomy:
+    """ Index taxonomy table by taxid and accession """
+
+    # Same columns as in written tables, so types do not depend on the data
+    df = table_io.categorize(df)
+
+    # First row of each taxid, as would be kept by drop_duplicates()
+    by_taxid = df.drop_duplicates('taxid').set_index('taxid', drop=False)
+
+    # Accessions have a row per sequence, but usually a single taxid
+    by_accession = df.drop_duplicates(['accession', 'taxid']).set_index(
+        'accession', drop=False)
+
+    return Taxonomy(df, by_taxid.rename_axis(None),
+                    by_accession.rename_axis(None))
+
+
+# --------------------------------------------------
+def test_index_taxonomy() -> None:
+    """ Test index_taxonomy() """
+
+    df = pd.DataFrame(
+        [['archaea', 'GCF_000006175.1', 'NC_014222.1', 456320],
+         ['archaea', 'GCF_000006175.1', 'NC_014223.1', 456320],
+         ['bacteria', 'GCF_003860425.1', 'NZ_CP034193.1', 1613],
+         ['bacteria', 'GCF_003860426.1', 'NZ_CP034194.1', 1613]],
+        columns=['kingdom', 'accession', 'seq_id', 'taxid'])
+
+    tax = index_taxonomy(df)
+
+    assert tax.df['kingdom'].dtype == 'category'
+    assert tax.df['seq_id'].dtype == object
+    assert_frame_equal(tax.df.astype({'kingdom': object}), df)
+
+    # Only set columns are categorical, however often values repeat
+    genus_df = df.assign(genus=['Methanococcus'] * 2 + ['Escherichia'] * 2)
+    assert index_taxonomy(genus_df).df['genus'].dtype == object
+
+    assert list(tax.by_taxid.index) == [456320, 1613]
+    assert list(tax.by_taxid['seq_id']) == ['NC_014222.1', 'NZ_CP034193.1']
+    assert tax.by_taxid.loc[1613, 'accession'] == 'GCF_003860425.1'
+
+    assert list(tax.by_accession.index) == [
+        'GCF_000006175.1', 'GCF_003860425.1', 'GCF_003860426.1'
+    ]
+    assert tax.by_accession.loc['GCF_003860426.1', 'taxid'] == 1613
+
+    # Indexes can be dropped without clashing with columns
+    assert list(tax.by_taxid.reset_index()['index']) == [456320, 1613]
+
+
+# --------------------------------------------------
+def read_cache(filename: str, key: FileKey) -> Optional[Taxonomy]:
+    """ Read cached taxonomy if it was made from the current file """
+
+    # Cache is only an optimization, and may have been written by other
+    # versions of pandas or numpy that cannot be loaded here
+    try:
+        with open(filename + CACHE_SUFFIX, 'rb') as fh:
+            cache = pickle.load(fh)
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    if not isinstance(cache, dict) or \
+            cache.get('version') != CACHE_VERSION or \
+            cache.get('pandas') != pd.__version__:
+        return None
+
+    # File was touched or copied without being changed
+    if FileKey(*cache['key']) != key:
+        if cache['key'][1] != key.size:
+            return None
+        if cache['sha256'] != hash_file(filename):
+            return None
+        write_cache(filename, key, cache['sha256'], cache['taxonomy'])
+
+    return Taxonomy(*cache['taxonomy'])
+
+
+# --------------------------------------------------
+def write_cache(filename: str, key: FileKey, sha256: str,
+                tax: Taxonomy) -> None:
+    """ Write taxonomy cache, if the directory is writable """
+
+    cache = {
+        'version': CACHE_VERSION,
+        'pandas': pd.__version__,
+        'key': tuple(key),
+        'sha256': sha256,
+        'taxonomy': tuple(tax)
+    }
+
+    cache_dir = os.path.dirname(os.path.abspath(filename))
+
+    # Written under another name first, so readers see a whole file
+    try:
+        fd, tmp_name = make_temp_file(cache_dir, CACHE_SUFFIX)
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(cache, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, filename + CACHE_SUFFIX)
+    except OSError:
+        os.remove(tmp_name)
+
+
+# --------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def read_taxonomy(filename: str, key: FileKey) -> Taxonomy:
+    """ Read taxonomy from cache, or from the file and cache it """
+
+    tax = read_cache(filename, key)
+
+    if tax is None:
+        sha256 = hash_file(filename)
+        tax = index_taxonomy(pd.read_csv(filename))
+        write_cache(filename, key, sha256, tax)
+
+    return tax
+
+
+# --------------------------------------------------
+def load_taxonomy(filename: str) -> Taxonomy:
+    """ Load taxonomy, only reading it once per process """
+
+    filename = os.path.realpath(filename)
+
+    return read_taxonomy(filename, get_file_key(filename))
+
+
+# --------------------------------------------------
+def test_load_taxonomy(tmp_path) -> None:
+    """ Test load_taxonomy() """
+
+    filename = str(tmp_path / 'taxonomy.csv')
+    with open(filename, 'wt') as fh:
+        fh.write('kingdom,accession,taxid\n'
+                 'viral,GCF_001,10\n'
+                 'viral,GCF_002,20\n')
+
+    tax = load_taxonomy(filename)
+
+    assert list(tax.by_taxid['accession']) == ['GCF_001', 'GCF_002']
+    assert os.path.isfile(filename + CACHE_SUFFIX)
+
+    # Cache can be read by other users, as allowed by the umask
+    assert os.stat(filename + CACHE_SUFFIX).st_mode & 0o777 == \
+        0o666 & ~get_umask()
+
+    # Same table is returned while file is unchanged
+    assert load_taxonomy(filename) is tax
+
+    # Cache is used when file is touched but not changed
+    os.utime(filename, ns=(0, 0))
+    key = get_file_key(filename)
+    cached = read_cache(filename, key)
+    assert cached is not None
+    assert_frame_equal(cached.by_accession, tax.by_accession)
+
+    # Cache was updated with new modification time
+    with open(filename + CACHE_SUFFIX, 'rb') as fh:
+        assert pickle.load(fh)['key'] == key
+
+    # Changed file is read again
+    with open(filename, 'at') as fh:
+        fh.write('bacteria,GCF_003,30\n')
+
+    assert list(load_taxonomy(filename).by_taxid.index) == [10, 20, 30]
+
+    # Cache from another version of pandas is not used
+    key = get_file_key(filename)
+    with open(filename + CACHE_SUFFIX, 'rb') as fh:
+        cache = pickle.load(fh)
+    cache['pandas'] = '0.0.0'
+    with open(filename + CACHE_SUFFIX, 'wb') as fh:
+        pickle.dump(cache, fh)
+
+    assert read_cache(filename, key) is None
+
+    # Cache that cannot be loaded is not used
+    with open(filename + CACHE_SUFFIX, 'wb') as fh:
+        fh.write(b'\x80\x05not a pickle')
+
+    assert read_cache(filename, key) is None
@@ -94,6 +94,54 @@ def test_runs_okay():
             shutil.rmtree(out_dir)
 
 
+# --------------------------------------------------
+def test_bad_threads():
+    """ Dies on bad number of threads """
+
+    retval, out = getstatusoutput(f'{PRG} -n 0 -t {TAX} {INPUT1}')
+    assert retval != 0
+    assert out.lower().startswith('usage:')
+    assert re.search(r'Number of threads \(0\) must be greater than 0', out)
+
+
+# --------------------------------------------------
+def test_runs_dir():
+    """ Runs on directory of Bracken files in parallel """
+
+    out_dir = random_string()
+    in_dir = os.path.join(out_dir, 'bracken')
+
+    try:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+        os.makedirs(in_dir)
+        for name in ['sample_1.txt', 'sample_2.txt', 'sample_3.txt']:
+            shutil.copy(INPUT1, os.path.join(in_dir, name))
+
+        rv, out = getstatusoutput(
+            f'{PRG} -np 1 -n 2 -o {out_dir} -t {TAX} -d {in_dir}')
+
+        assert rv == 0
+        assert re.search(f'Done. Wrote 3 profiles to {out_dir}', out)
+
+        # Same output as when run alone
+        rv, out = getstatusoutput(
+            f'{PRG} -np 1 -o {in_dir} -t {TAX} {INPUT1}')
+
+        assert rv == 0
+        for name in ['sample_1', 'sample_2', 'sample_3']:
+            for suffix in ['_files.txt', '_profile.txt']:
+                expected = open(os.path.join(in_dir,
+                                             'input_1' + suffix)).read()
+                assert open(os.path.join(out_dir,
+                                         name + suffix)).read() == expected
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
 # --------------------------------------------------
 def random_string() -> str:
     """ Generate a random string """
@@ -101,6 +101,16 @@ def test_wrong_parent():
     assert re.search('"tests"', out)
 
 
+# --------------------------------------------------
+def test_bad_cache_size():
+    """ Cache size must be positive """
+
+    retval, out = getstatusoutput(f'{PRG} -p {REFSEQ} -s 0 {INPUT1}')
+    assert retval != 0
+    assert out.lower().startswith('usage:')
+    assert re.search(r'--cache_size \(0.0\) must be greater than 0', out)
+
+
 # --------------------------------------------------
 def test_runs_okay():
     """ Runs with good input """
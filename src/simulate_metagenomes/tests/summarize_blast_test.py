@@ -1,6 +1,9 @@
 """ Tests """
 
+import gzip
 import os
+import pandas as pd
+import pytest
 import random
 import re
 import shutil
@@ -9,6 +12,7 @@ from subprocess import getstatusoutput
 
 PRG = './summarize_blast.py'
 INPUT = 'tests/inputs/summarize_blast/input_1_blast_out.xml'
+TABULAR = 'tests/inputs/summarize_blast/input_2_blast_out.tsv'
 
 
 # --------------------------------------------------
@@ -23,6 +27,7 @@ def test_testing_environment() -> None:
     """ Test files are in place """
 
     assert os.path.isfile(INPUT)
+    assert os.path.isfile(TABULAR)
 
 
 # --------------------------------------------------
@@ -90,6 +95,102 @@ def test_runs_low_mem() -> None:
     run('--low_mem')
 
 
+# --------------------------------------------------
+def test_runs_threads() -> None:
+    """ Runs with several worker processes """
+
+    run('--threads 2')
+
+
+# --------------------------------------------------
+def test_bad_threads() -> None:
+    """ Dies on bad number of threads """
+
+    retval, out = getstatusoutput(f'{PRG} -n 0 {INPUT}')
+    assert retval != 0
+    assert out.lower().startswith('usage:')
+    assert re.search('Number of threads', out)
+
+
+# --------------------------------------------------
+def test_runs_gzip() -> None:
+    """ Reads gzip-compressed input """
+
+    out_dir = random_string()
+    gz_file = os.path.join(out_dir, 'input_1_blast_out.xml.gz')
+
+    try:
+        os.makedirs(out_dir)
+        with open(INPUT, 'rb') as in_fh, gzip.open(gz_file, 'wb') as out_fh:
+            out_fh.write(in_fh.read())
+
+        rv, out = getstatusoutput(f'{PRG} -o {out_dir} {gz_file}')
+
+        assert rv == 0
+        out_file = os.path.join(out_dir, 'input_1_parsed_blast.csv')
+        assert re.search(f'Done. Wrote output to {out_file}.', out)
+        out_lines = open(out_file).read().count('\n')
+        blast_hits = open(INPUT).read().count('Hit_num') / 2
+        assert out_lines == blast_hits + 1
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_runs_formats() -> None:
+    """ Writes typed columnar tables """
+
+    pytest.importorskip('pyarrow')
+
+    out_dir = random_string()
+
+    try:
+        rv, _ = getstatusoutput(f'{PRG} -o {out_dir} {INPUT}')
+        assert rv == 0
+        csv_df = pd.read_csv(os.path.join(out_dir,
+                                          'input_1_parsed_blast.csv'))
+
+        for fmt in ['parquet', 'feather']:
+            rv, out = getstatusoutput(f'{PRG} -F {fmt} -o {out_dir} {INPUT}')
+
+            assert rv == 0
+            out_file = os.path.join(out_dir, f'input_1_parsed_blast.{fmt}')
+            assert re.search(f'Done. Wrote output to {out_file}.', out)
+
+            out_df = getattr(pd, f'read_{fmt}')(out_file)
+            assert out_df.equals(csv_df)
+            assert out_df['e_val'].dtype == 'float64'
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
+# --------------------------------------------------
+def test_runs_tabular() -> None:
+    """ Tabular input gives the same output as XML """
+
+    out_dir = random_string()
+
+    try:
+        rv, out = getstatusoutput(f'{PRG} -o {out_dir} {INPUT}')
+        assert rv == 0
+
+        rv, out = getstatusoutput(f'{PRG} -o {out_dir} {TABULAR}')
+        assert rv == 0
+        out_file = os.path.join(out_dir, 'input_2_parsed_blast.csv')
+        assert re.search(f'Done. Wrote output to {out_file}.', out)
+
+        xml_out = os.path.join(out_dir, 'input_1_parsed_blast.csv')
+        assert open(out_file).read() == open(xml_out).read()
+
+    finally:
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+
 # --------------------------------------------------
 def random_string() -> str:
     """ Generate a random string """
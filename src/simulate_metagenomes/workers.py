@@ -0,0 +1,26 @@
+"""
+Functions for choosing how many worker processes to run
+"""
+
+import os
+
+
+# --------------------------------------------------
+def get_n_cpus() -> int:
+    """ Get number of CPUs this process may run on """
+
+    # Respects CPUs allocated by a scheduler, unlike cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+# --------------------------------------------------
+def test_get_n_cpus() -> None:
+    """ Test get_n_cpus() """
+
+    n_cpus = get_n_cpus()
+
+    assert n_cpus >= 1
+    assert n_cpus <= (os.cpu_count() or n_cpus)
@@ -7,10 +7,17 @@ Purpose: Create profile of phages
 
 import argparse
 import os
+import sys
 import pandas as pd
 from pandas.testing import assert_frame_equal
 from typing import NamedTuple, TextIO, Tuple
 
+# Taxonomy is loaded with the module shared by simulate_metagenomes
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                 'simulate_metagenomes'))
+from taxonomy import load_taxonomy  # type: ignore # noqa: E402
+
 pd.options.mode.chained_assignment = None
 
 
@@ -87,7 +94,7 @@ def main() -> None:
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
 
-    taxonomy_df = clean_taxonomy(pd.read_csv(args.taxonomy))
+    taxonomy_df = clean_taxonomy(load_taxonomy(args.taxonomy.name).by_taxid)
 
     phages = get_phages(taxonomy_df)
 